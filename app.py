@@ -1,14 +1,25 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, stream_with_context
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, stream_with_context, g
 import os
+import time
 import requests
-import re
-import json
+import hashlib
 import argparse
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 import uuid
 from datetime import timedelta, datetime
-import traceback
+from contextlib import closing
+from storage import ConversationStore, HistoryCache, ThreadIndex, FileIndex, CacheSync, SHARED_SESSION
+import ollama_client
+from ollama_client import generation_limiter, QueueFull
+from streaming import ChatStreamParser, SSECoalescer, iter_with_timeouts, sse
+from documents import DocumentStore, UploadTooLarge, MAX_UPLOAD_BYTES
+from context import fit_context
+from titles import TitleQueue
+from logs import get_logger
+import metrics
 app = Flask(__name__, static_folder='static')
+log = get_logger('app')
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your-default-secret-key-123')
 app.config.update(
     PERMANENT_SESSION_LIFETIME=timedelta(days=7),
@@ -19,450 +30,613 @@ app.config.update(
 )
 UPLOAD_FOLDER = 'uploads'
 DATA_FOLDER = 'data'
+# Room for the multipart boundary and headers around an upload of MAX_UPLOAD_BYTES
+UPLOAD_FORM_OVERHEAD = 64 * 1024
 ALLOWED_EXTENSIONS = {'txt', 'py', 'js', 'css', 'html', 'sh', 'md', 'json', 'csv', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['DATA_FOLDER'] = DATA_FOLDER
-conversations = {}
-threads = {}
+# Werkzeug stops reading any request body past this, including chunked uploads and multipart forms it spools to disk
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD
+threads = ThreadIndex()
+files = FileIndex()
+store = ConversationStore(os.path.join(DATA_FOLDER, 'kitt.db'))
+documents = DocumentStore(UPLOAD_FOLDER)
+history_cache = HistoryCache(store, max_threads=int(os.environ.get('KITT_HISTORY_CACHE_SIZE', '256')))
+# Picks up writes from other worker processes (see wsgi.py) before each request
+cache_sync = CacheSync(store, threads, history_cache, files)
 DEFAULT_THREAD_NAME = "New Thread"
+RETRIEVAL_ENABLED = os.environ.get('KITT_RETRIEVAL', '0') == '1'
+RETRIEVAL_TOP_K = int(os.environ.get('KITT_RETRIEVAL_TOP_K', '8'))
+RETRIEVAL_MAX_CHARS = int(os.environ.get('KITT_RETRIEVAL_MAX_CHARS', '12000'))
 DEFAULT_FILE_CONTEXT_INTRO = "I'm going to reference some files. Please consider these in your response:" # Define default here too
+# Where file context goes: 'prefix' (with the system prompt, so the start of the prompt stays the same across turns
+# and Ollama can reuse its cache), 'prepend' or 'append' (around the latest user message)
+CONTEXT_PLACEMENT = os.environ.get('KITT_CONTEXT_PLACEMENT', 'prefix')
+SEARCH_MAX_RESULTS = 100
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-def save_data():
-    data_path = os.path.join(app.config['DATA_FOLDER'], 'conversations.json')
-    threads_path = os.path.join(app.config['DATA_FOLDER'], 'threads.json')
+def persist(action, *args, **kwargs):
+    started = time.perf_counter()
     try:
-        os.makedirs(app.config['DATA_FOLDER'], exist_ok=True)
-        conv_copy = conversations.copy()
-        threads_copy = threads.copy()
-        with open(data_path, 'w') as f:
-            json.dump(conv_copy, f, indent=2)
-        with open(threads_path, 'w') as f:
-            json.dump(threads_copy, f, indent=2)
+        written = action(*args, **kwargs)
+        metrics.store_write_seconds.labels(action.__name__).observe(time.perf_counter() - started)
+        if written: metrics.store_write_bytes.labels(action.__name__).inc(written)
         return True
     except Exception as e:
-        print(f"Error saving data: {str(e)}")
-        traceback.print_exc()
+        log.exception(f"Error saving data: {e}")
         return False
-def load_data():
-    global conversations, threads
-    data_path = os.path.join(app.config['DATA_FOLDER'], 'conversations.json')
-    threads_path = os.path.join(app.config['DATA_FOLDER'], 'threads.json')
+def load_data(force_import=False):
     try:
-        if os.path.exists(data_path):
-            with open(data_path, 'r') as f:
-                conversations = json.load(f)
-                print(f"Loaded {len(conversations)} sessions from conversations.json")
-        else: conversations = {}; print("conversations.json not found.")
-        if os.path.exists(threads_path):
-            with open(threads_path, 'r') as f:
-                threads = json.load(f)
-                print(f"Loaded {len(threads)} sessions from threads.json")
-        else: threads = {}; print("threads.json not found.")
+        store.import_json(app.config['DATA_FOLDER'], force=force_import)
+        store.build_search_index()
+        if not store.get_meta('uploads_imported'):
+            # Files from before per-session uploads stay visible to every session
+            for entry in documents.import_legacy(): store.save_file(SHARED_SESSION, entry)
+            store.set_meta('uploads_imported', '1')
+        cache_sync.reset()
+        sessions = store.load_threads()
+        threads.load(sessions)
+        files.load(store.load_files())
+        log.info(f"Loaded thread metadata for {len(sessions)} sessions from {store.db_path}")
         return True
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON data: {str(e)}. Starting empty.")
-        conversations = {}; threads = {}
-        return False
     except Exception as e:
-        print(f"Error loading data: {str(e)}"); traceback.print_exc()
-        conversations = {}; threads = {}
+        log.exception(f"Error loading data from {store.db_path}: {e}")
+        threads.load({}); files.load({})
         return False
+def find_thread(session_id, thread_id):
+    return threads.get(session_id, thread_id)
+def _comparable(msg):
+    return {k: v for k, v in msg.items() if v is not None}
+def common_prefix_length(old_messages, new_messages):
+    keep = 0
+    for old_msg, new_msg in zip(old_messages, new_messages):
+        if _comparable(old_msg) != _comparable(new_msg): break
+        keep += 1
+    return keep
+def is_chat_message(msg):
+    return isinstance(msg, dict) and msg.get('role') in ['user', 'assistant'] and 'content' in msg
+def to_persistent_message(msg):
+    persistent_msg = {
+        "id": msg.get('id') if msg.get('id') and not str(msg.get('id')).startswith('temp-') else str(uuid.uuid4()),
+        "role": msg['role'],
+        "content": msg['content'], # Save the user's text without the prepended/appended context
+    }
+    if msg['role'] == 'user': persistent_msg['referencedFiles'] = msg.get('referencedFiles') or [] # Save referenced files with user message
+    # Only include thinking if it exists and is not None
+    if msg.get('thinking') is not None: persistent_msg['thinking'] = msg['thinking']
+    return persistent_msg
+def apply_history_ops(history, data):
+    # Incremental chat payload: optional `edit` {id, content} or `truncateAfter` id, then an optional new user `message`.
+    # Returns the new message list and how many leading messages are unchanged.
+    messages = list(history)
+    keep = len(messages)
+    index_by_id = {msg.get('id'): i for i, msg in enumerate(messages)}
+    edit = data.get('edit')
+    if edit:
+        if not isinstance(edit, dict) or edit.get('id') not in index_by_id or not isinstance(edit.get('content'), str):
+            raise ValueError("Edited message not found in thread")
+        keep = index_by_id[edit['id']]
+        messages = messages[:keep] + [{**messages[keep], 'content': edit['content']}]
+    truncate_after = data.get('truncateAfter')
+    if truncate_after:
+        if truncate_after not in index_by_id: raise ValueError("Message to truncate after not found in thread")
+        messages = messages[:index_by_id[truncate_after] + 1]
+        keep = min(keep, len(messages))
+    message = data.get('message')
+    if message:
+        if not isinstance(message, dict) or not isinstance(message.get('content'), str): raise ValueError("Invalid message")
+        messages.append(to_persistent_message({**message, 'role': 'user', 'id': None}))
+    return messages, keep
+def build_ollama_messages(system_prompt, messages, context_prefix, placement):
+    ollama_messages = []
+    if placement == 'prefix' and context_prefix:
+        # One system message holding the prompt and the files: it only changes when they do, so turns share a prefix
+        ollama_messages.append({"role": "system", "content": f"{system_prompt}\n\n{context_prefix}" if system_prompt else context_prefix})
+    elif system_prompt: ollama_messages.append({"role": "system", "content": system_prompt})
+    for i, msg in enumerate(messages):
+        ollama_content = msg['content']
+        # --- Apply File Context based on settings ---
+        is_last_user_message = (i == len(messages) - 1 and msg['role'] == 'user')
+        if is_last_user_message and context_prefix and placement != 'prefix':
+            if placement == 'append':
+                # Append context *after* user message
+                ollama_content = f"{msg['content']}\n\n{context_prefix}"
+                log.debug("Appending file context for message %d", i)
+            else:
+                # Prepend context *before* user message (default)
+                ollama_content = f"{context_prefix}\n\n{msg['content']}"
+                log.debug("Prepending file context for message %d", i)
+        ollama_messages.append({"role": msg['role'], "content": ollama_content})
+    return ollama_messages
 def get_session_data():
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
-        print(f"New session created: {session['session_id']}")
+        log.info(f"New session created: {session['session_id']}")
     session_id = session['session_id']
-    threads.setdefault(session_id, [])
-    conversations.setdefault(session_id, {})
     active_thread_id = session.get('active_thread')
-    valid_active_thread_exists = active_thread_id and active_thread_id in conversations[session_id]
+    valid_active_thread_exists = active_thread_id and find_thread(session_id, active_thread_id) is not None
     if not valid_active_thread_exists:
-        session_threads = threads[session_id]
-        if session_threads:
-            session_threads.sort(key=lambda x: x.get('updated_at', ''), reverse=True)
-            potential_active_id = session_threads[0]['id']
-            if potential_active_id in conversations[session_id]:
-                 session['active_thread'] = potential_active_id
-                 print(f"Set active thread to most recent: {potential_active_id} for session {session_id}")
-            else:
-                 valid_active_thread_exists = False
-        else:
-             valid_active_thread_exists = False
+        most_recent = threads.most_recent(session_id)
+        if most_recent:
+            potential_active_id = most_recent['id']
+            session['active_thread'] = potential_active_id
+            valid_active_thread_exists = True
+            log.info(f"Set active thread to most recent: {potential_active_id} for session {session_id}")
         if not valid_active_thread_exists:
-            print(f"No valid active thread found for session {session_id}. Creating default.")
+            log.info(f"No valid active thread found for session {session_id}. Creating default.")
             default_thread_id = str(uuid.uuid4())
             now = datetime.now().isoformat()
             default_thread = { 'id': default_thread_id, 'name': DEFAULT_THREAD_NAME, 'created_at': now, 'updated_at': now }
-            threads[session_id].insert(0, default_thread)
-            conversations[session_id][default_thread_id] = []
+            threads.add(session_id, default_thread)
+            history_cache.put(session_id, default_thread_id, [])
             session['active_thread'] = default_thread_id
-            print(f"Created and activated default thread {default_thread_id} for session {session_id}")
-            save_data()
+            log.info(f"Created and activated default thread {default_thread_id} for session {session_id}")
+            persist(store.save_thread, session_id, default_thread)
     return session_id, session.get('active_thread')
-def get_uploaded_files():
-    upload_folder = app.config['UPLOAD_FOLDER']
-    if not os.path.exists(upload_folder): os.makedirs(upload_folder); return []
+def release_blob(sha256):
+    # Deletes an upload's content once no file name in any session refers to it
     try:
-        files = [f for f in os.listdir(upload_folder) if os.path.isfile(os.path.join(upload_folder, f)) and not f.startswith('.')]
-        return sorted(files)
-    except Exception as e: print(f"Error listing uploaded files: {e}"); return []
+        if not store.file_referenced(sha256): documents.remove(sha256); log.info(f"Removed unreferenced upload {sha256[:12]}")
+    except Exception as e: log.exception(f"Error removing upload {sha256[:12]}: {e}")
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 @app.before_request
 def ensure_session():
+    if request.endpoint == 'get_metrics': return  # scrapers have no session and must not create threads
     session.permanent = True
+    cache_sync.poll()
     get_session_data()
+@app.after_request
+def record_request_duration(response):
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.request_duration.labels(request.method, route, response.status_code).observe(time.perf_counter() - g.request_started)
+    return response
+@app.route('/metrics')
+def get_metrics():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
 @app.route('/')
 def index():
     session_id, active_thread_id = get_session_data()
-    print(f"Serving index page for session {session_id}, active thread {active_thread_id}")
-    return render_template('index.html')
+    log.debug(f"Serving index page for session {session_id}, active thread {active_thread_id}")
+    return render_template('index.html', retrieval_default=RETRIEVAL_ENABLED, context_placement_default=CONTEXT_PLACEMENT)
+def models_response(models, etag, last_modified):
+    response = jsonify(models)
+    # Let the browser keep the list and revalidate it with If-None-Match / If-Modified-Since
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 @app.route('/api/models', methods=['GET'])
 def get_models():
     try:
-        ollama_url = os.environ.get('OLLAMA_API_URL', 'http://localhost:11434')
-        response = requests.get(f'{ollama_url}/api/tags', timeout=10)
-        response.raise_for_status()
-        models_data = response.json()
-        models = models_data.get('models', [])
-        models.sort(key=lambda x: x.get('name', ''))
-        return jsonify(models)
+        return models_response(*ollama_client.model_catalog.models())
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching models from Ollama: {e}")
+        log.warning(f"Error fetching models from Ollama: {e}")
         return jsonify({"error": f"Could not connect to Ollama API: {e}"}), 503
     except Exception as e:
-        print(f"Unexpected error fetching models: {e}"); traceback.print_exc()
+        log.exception(f"Unexpected error fetching models: {e}")
         return jsonify({"error": "An unexpected error occurred while fetching models"}), 500
+@app.route('/api/models/refresh', methods=['POST'])
+def refresh_models():
+    try:
+        return models_response(*ollama_client.model_catalog.refresh())
+    except requests.exceptions.RequestException as e:
+        log.warning(f"Error refreshing models from Ollama: {e}")
+        return jsonify({"error": f"Could not connect to Ollama API: {e}"}), 503
+@app.route('/api/models/warm', methods=['POST'])
+def warm_model():
+    # Loads the model into Ollama's memory ahead of the first chat, e.g. as soon as it is picked in the UI
+    model = (request.json or {}).get('model')
+    if not model: return jsonify({"error": "Model is required"}), 400
+    warming = ollama_client.model_sessions.warm(model)
+    return jsonify({"success": True, "model": model, "warming": warming, "keep_alive": ollama_client.model_sessions.keep_alive(model)}), 202
+@app.route('/api/models/details', methods=['GET'])
+def get_model_details():
+    return jsonify(ollama_client.model_catalog.cached_details())
+def history_page(history, limit=None, before=None, since=None):
+    # Selects part of a thread: the last `limit` messages (before message `before`), or everything after message `since`.
+    # Returns the response fields, or None when the referenced message is not in the thread.
+    ids = [msg.get('id') for msg in history]
+    if since:
+        if since not in ids: return None
+        start = ids.index(since) + 1
+        return {"history": history[start:], "offset": start, "total": len(history), "since": since}
+    end = len(history)
+    if before:
+        if before not in ids: return None
+        end = ids.index(before)
+    start = max(0, end - limit) if limit and limit > 0 else 0
+    return {"history": history[start:end], "offset": start, "total": len(history), "has_more": start > 0}
+def history_response(session_id, thread_id, body):
+    # The thread's updated_at changes on every write, so with the length and query it identifies this response
+    thread = find_thread(session_id, thread_id) or {}
+    response = jsonify(body)
+    response.set_etag(hashlib.sha1(f"{thread_id}:{thread.get('updated_at')}:{body.get('total')}:{request.query_string.decode()}".encode()).hexdigest()[:20])
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    return response.make_conditional(request)
 @app.route('/api/conversation/history', methods=['GET'])
 def get_conversation_history():
+    # ?limit=N returns the last N messages, ?before=<id>&limit=N the N before a message, ?since=<id> the messages after one.
+    # `offset` is the position of the first returned message in the thread.
     session_id, thread_id = get_session_data()
-    history = conversations.get(session_id, {}).get(thread_id, [])
-    print(f"Returning history for thread {thread_id} (Session: {session_id}), Length: {len(history)}")
-    return jsonify({"success": True, "history": history, "thread_id": thread_id}), 200
+    history = history_cache.get(session_id, thread_id)
+    limit, since = request.args.get('limit', type=int), request.args.get('since')
+    page = history_page(history, limit=limit, before=request.args.get('before'), since=since)
+    if page is None:
+        if not since: return jsonify({"error": "Message not found in this thread"}), 404
+        # The thread changed under the client (e.g. truncated elsewhere): send a fresh page instead of a delta
+        page = history_page(history, limit=limit) | {"reset": True}
+    log.debug(f"Returning {len(page['history'])} of {len(history)} messages for thread {thread_id} (Session: {session_id})")
+    return history_response(session_id, thread_id, {"success": True, "thread_id": thread_id, **page})
 @app.route('/api/threads', methods=['GET'])
 def get_threads_list():
     session_id, active_thread_id = get_session_data()
-    session_threads = threads.get(session_id, [])
-    session_threads.sort(key=lambda x: x.get('updated_at', ''), reverse=True)
-    return jsonify({"success": True, "threads": session_threads, "active_thread": active_thread_id}), 200
+    # Without ?limit= every thread is returned; with it, pass next_cursor back as ?cursor= for the next page
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+    if cursor and '|' not in cursor: return jsonify({"error": "Invalid cursor"}), 400
+    page, next_cursor = threads.page(session_id, limit=max(1, limit) if limit else None, cursor=cursor)
+    return jsonify({"success": True, "threads": page, "active_thread": active_thread_id,
+                    "next_cursor": next_cursor, "total": threads.count(session_id)}), 200
+@app.route('/api/search', methods=['GET'])
+def search_conversations():
+    # ?q=words finds this session's messages and thread names containing every word (the last one as a prefix),
+    # best matches first; pass next_offset back as ?offset= for more
+    session_id, _ = get_session_data()
+    query = request.args.get('q', '').strip()
+    limit = min(max(1, request.args.get('limit', default=20, type=int)), SEARCH_MAX_RESULTS)
+    offset = max(0, request.args.get('offset', default=0, type=int))
+    if not store.search_enabled: return jsonify({"error": "Search is not available"}), 503
+    hits = store.search(session_id, query, limit, offset) if query else []
+    results = []
+    for hit in hits:
+        thread = find_thread(session_id, hit['thread_id'])
+        if thread is None: continue  # deleted by another worker since
+        results.append({**hit, "thread_name": thread['name'], "updated_at": thread.get('updated_at')})
+    return jsonify({"success": True, "query": query, "results": results,
+                    "next_offset": offset + len(hits) if len(hits) == limit else None}), 200
 @app.route('/api/threads/new', methods=['POST'])
 def create_thread():
     session_id, _ = get_session_data()
     thread_id = str(uuid.uuid4())
     now = datetime.now().isoformat()
     new_thread = { 'id': thread_id, 'name': DEFAULT_THREAD_NAME, 'created_at': now, 'updated_at': now }
-    threads.setdefault(session_id, []).insert(0, new_thread)
-    conversations.setdefault(session_id, {})[thread_id] = []
+    threads.add(session_id, new_thread)
+    history_cache.put(session_id, thread_id, [])
     session['active_thread'] = thread_id
-    print(f"Created new thread {thread_id} for session {session_id}")
-    if save_data():
+    log.info(f"Created new thread {thread_id} for session {session_id}")
+    if persist(store.save_thread, session_id, new_thread):
         return jsonify({"success": True, "thread": new_thread}), 201
     else:
         return jsonify({"error": "Failed to save new thread data"}), 500
 @app.route('/api/threads/<thread_id>/activate', methods=['POST'])
 def activate_thread(thread_id):
     session_id, current_active_thread = get_session_data()
-    session_threads = threads.get(session_id, [])
-    thread_exists = any(t['id'] == thread_id for t in session_threads)
-    conversation_exists = thread_id in conversations.get(session_id, {})
-    if not thread_exists or not conversation_exists:
-        print(f"Attempt to activate non-existent or invalid thread {thread_id} in session {session_id}")
+    if find_thread(session_id, thread_id) is None:
+        log.warning(f"Attempt to activate non-existent or invalid thread {thread_id} in session {session_id}")
         return jsonify({"error": "Thread not found or invalid"}), 404
     if thread_id == current_active_thread:
-        print(f"Thread {thread_id} is already active.")
-        history = conversations[session_id][thread_id]
-        return jsonify({"success": True, "thread_id": thread_id, "history": history}), 200
-    session['active_thread'] = thread_id
-    print(f"Activated thread {thread_id} for session {session_id}")
-    history = conversations[session_id][thread_id]
-    return jsonify({"success": True, "thread_id": thread_id, "history": history}), 200
+        log.debug(f"Thread {thread_id} is already active.")
+    else:
+        session['active_thread'] = thread_id
+        log.info(f"Activated thread {thread_id} for session {session_id}")
+    # ?limit=N returns only the last N messages, as for /api/conversation/history
+    page = history_page(history_cache.get(session_id, thread_id), limit=request.args.get('limit', type=int))
+    return jsonify({"success": True, "thread_id": thread_id, **page}), 200
 @app.route('/api/threads/<thread_id>/rename', methods=['POST'])
 def rename_thread(thread_id):
     session_id, _ = get_session_data()
     data = request.json
     new_name = data.get('name', '').strip()
     if not new_name: return jsonify({"error": "New name cannot be empty"}), 400
-    session_threads = threads.get(session_id, [])
-    thread_found = False
-    for thread in session_threads:
-        if thread['id'] == thread_id:
-            thread['name'] = new_name
-            thread['updated_at'] = datetime.now().isoformat()
-            thread_found = True
-            print(f"Renamed thread {thread_id} to '{new_name}' for session {session_id}")
-            break
-    if not thread_found: return jsonify({"error": "Thread not found"}), 404
-    if save_data(): return jsonify({"success": True, "thread_id": thread_id, "new_name": new_name}), 200
+    thread = threads.touch(session_id, thread_id)
+    if not thread: return jsonify({"error": "Thread not found"}), 404
+    thread['name'] = new_name
+    log.info(f"Renamed thread {thread_id} to '{new_name}' for session {session_id}")
+    if persist(store.save_thread, session_id, thread): return jsonify({"success": True, "thread_id": thread_id, "new_name": new_name}), 200
     else: return jsonify({"error": "Failed to save renamed thread data"}), 500
 @app.route('/api/threads/<thread_id>/delete', methods=['DELETE'])
 def delete_thread(thread_id):
     session_id, active_thread_id = get_session_data()
-    session_threads = threads.get(session_id, [])
-    thread_index = next((i for i, t in enumerate(session_threads) if t['id'] == thread_id), -1)
-    if thread_index == -1: return jsonify({"error": "Thread not found"}), 404
-    deleted_thread_name = threads[session_id].pop(thread_index)['name']
-    print(f"Deleted thread {thread_id} ('{deleted_thread_name}') from session {session_id}")
-    if thread_id in conversations.get(session_id, {}):
-        del conversations[session_id][thread_id]
-        print(f"Deleted conversation data for thread {thread_id}")
+    deleted_thread = threads.remove(session_id, thread_id)
+    if deleted_thread is None: return jsonify({"error": "Thread not found"}), 404
+    deleted_thread_name = deleted_thread['name']
+    log.info(f"Deleted thread {thread_id} ('{deleted_thread_name}') from session {session_id}")
+    history_cache.discard(session_id, thread_id)
     new_active_thread_id = active_thread_id
+    if not persist(store.delete_thread, session_id, thread_id):
+        return jsonify({"error": "Failed to save data after deleting thread"}), 500
     if active_thread_id == thread_id:
         _, new_active_thread_id = get_session_data()
-        print(f"Deleted thread was active. New active thread is {new_active_thread_id}")
-    if save_data():
-        return jsonify({"success": True, "active_thread": new_active_thread_id}), 200
+        log.info(f"Deleted thread was active. New active thread is {new_active_thread_id}")
+    return jsonify({"success": True, "active_thread": new_active_thread_id}), 200
+def prepare_chat(session_id, thread_id, data):
+    # Validates a chat request and saves the updated history.
+    # Returns (ollama_payload, context_report, None) or (None, None, (error, status)).
+    model = data.get('model')
+    frontend_messages = data.get('messages', [])
+    references = data.get('references', [])
+    system_prompt = data.get('systemPrompt', 'You are a helpful assistant.')
+    file_context_intro = data.get('fileContextIntro', DEFAULT_FILE_CONTEXT_INTRO)
+    placement = 'append' if data.get('appendContext') else data.get('contextPlacement') or CONTEXT_PLACEMENT
+    if placement not in ('prefix', 'prepend', 'append'): return None, None, ("Invalid contextPlacement", 400)
+    if not model: return None, None, ("Model is required", 400)
+    if not frontend_messages and not data.get('message') and not data.get('edit') and not data.get('truncateAfter'):
+        return None, None, ("Messages are required", 400)
+    use_retrieval = data.get('retrieval', RETRIEVAL_ENABLED)
+    options = data.get('options') if isinstance(data.get('options'), dict) else None
+    num_ctx = options.get('num_ctx') if options else None
+    if num_ctx is not None and (not isinstance(num_ctx, int) or isinstance(num_ctx, bool) or num_ctx <= 0):
+        return None, None, ("options.num_ctx must be a positive integer", 400)
+    history_offset = data.get('historyOffset') or 0
+    if not isinstance(history_offset, int) or isinstance(history_offset, bool) or history_offset < 0:
+        return None, None, ("historyOffset must be a non-negative integer", 400)
+    valid_refs = []
+    for ref in references or []:
+        entry = files.get(session_id, ref) if isinstance(ref, str) else None
+        if entry: valid_refs.append((ref, entry['sha256']))
+        else: log.warning(f"Ref not found: {ref}")
+    valid_refs.sort()  # the same files give the same context block, whatever order they were picked in
+    previous_messages = history_cache.get(session_id, thread_id)
+    if frontend_messages:
+        # Full-history mode: the client sent the whole thread, or everything after the first `historyOffset` stored messages
+        offset = min(history_offset, len(previous_messages))
+        persistent_messages = previous_messages[:offset] + [to_persistent_message(msg) for msg in frontend_messages if is_chat_message(msg)]
+        keep = common_prefix_length(previous_messages, persistent_messages)
     else:
-        return jsonify({"error": "Failed to save data after deleting thread"}), 500
+        # Incremental mode: apply the edit/truncate/append operations to the stored history
+        try: persistent_messages, keep = apply_history_ops(previous_messages, data)
+        except ValueError as e: return None, None, (str(e), 400)
+        if not persistent_messages or persistent_messages[-1]['role'] != 'user':
+            return None, None, ("The last message must be a user message", 400)
+    file_blocks = []
+    if valid_refs and use_retrieval:
+        # Only the chunks that best match the latest question, from the index built at upload time
+        query = next((msg['content'] for msg in reversed(persistent_messages) if msg['role'] == 'user'), '')
+        try: file_blocks = documents.render_relevant(valid_refs, query, RETRIEVAL_TOP_K, RETRIEVAL_MAX_CHARS)
+        except Exception as e: log.exception(f"Error selecting relevant chunks, using whole files: {e}")
+        # Excerpts depend on the question, so keep them out of the shared prefix
+        if file_blocks and placement == 'prefix': placement = 'prepend'
+    if valid_refs and not file_blocks:
+        for ref, sha256 in valid_refs:
+            # Extracted once at upload time; the rendered block is cached in memory
+            try: file_blocks.append((ref, documents.render(ref, sha256)))
+            except Exception as e: log.error(f"Error reading ref {ref}: {e}")
+    # Fit the history and files into the model's context window before building the prompt
+    # A num_ctx sent with the request overrides the model's own window, so budget against it
+    context_window = num_ctx or ollama_client.model_catalog.context_length(model)
+    history_to_send, context_parts, context_report = fit_context(
+        persistent_messages, file_blocks, system_prompt, context_window,
+        file_context_intro if file_blocks else '')
+    metrics.prompt_tokens.labels(model).observe(context_report['prompt_tokens'])
+    if context_report['dropped_tokens']:
+        log.info(f"Context budget for {model}: dropped {context_report['dropped_messages']} messages, "
+                 f"truncated {len(context_report['truncated_files'])} files ({context_report['dropped_tokens']} tokens)")
+    context_prefix = ""
+    if context_parts:
+        # Construct the full prefix using the user's intro sentence
+        context_prefix = f"{file_context_intro}\n" + "\n".join(context_parts)
+    ollama_messages = build_ollama_messages(system_prompt, history_to_send, context_prefix, placement)
+
+    # Save the history *before* sending to Ollama, writing only the messages that changed
+    thread = threads.touch(session_id, thread_id)
+    if not persist(store.write_messages, session_id, thread_id, keep, persistent_messages[keep:], thread):
+        return None, None, ("Failed to save state before chat", 500)
+    history_cache.put(session_id, thread_id, persistent_messages)
+    log.debug(f"Saved history (len {len(persistent_messages)}, {len(persistent_messages) - keep} changed) for thread {thread_id} before Ollama call")
+    payload = { "model": model, "messages": ollama_messages, "stream": True }
+    keep_alive = ollama_client.model_sessions.keep_alive(model)
+    if keep_alive is not None: payload['keep_alive'] = keep_alive
+    if options: payload['options'] = options
+    return payload, context_report, None
+def needs_title(session_id, thread_id):
+    thread = find_thread(session_id, thread_id)
+    return thread is not None and thread['name'] == DEFAULT_THREAD_NAME
+def apply_generated_title(session_id, thread_id, title):
+    # The user may have renamed (or deleted) the thread while the title was being generated
+    if not needs_title(session_id, thread_id): return
+    thread = find_thread(session_id, thread_id)
+    thread['name'] = title
+    persist(store.save_thread, session_id, thread)
+# All models share one Ollama server, so titles wait for any interactive chat to finish
+title_queue = TitleQueue(apply_generated_title, is_busy=lambda: generation_limiter.active() + generation_limiter.queued() > 0, needs_title=needs_title)
+def queue_title_if_needed(session_id, thread_id, history, model):
+    if needs_title(session_id, thread_id) and 2 <= len(history) <= 6:
+        title_queue.submit(session_id, thread_id, history, model)
+def record_stream_metrics(model, opened_at, parser, frames=None, prompt_tokens=None):
+    # Records the stream's timings and returns them for the client. A prompt_eval_count well below the estimated
+    # prompt size means Ollama reused its cache for the unchanged start of the prompt.
+    if parser.error: metrics.stream_errors.labels(model).inc()
+    if parser.first_chunk_at: metrics.first_chunk_seconds.labels(model).observe(parser.first_chunk_at - opened_at)
+    stats = parser.stats
+    if stats: ollama_client.model_sessions.touch(model)
+    if stats.get('total_duration'): metrics.stream_seconds.labels(model).observe(stats['total_duration'] / 1e9)
+    if stats.get('load_duration'): metrics.load_seconds.labels(model).observe(stats['load_duration'] / 1e9)
+    if stats.get('prompt_eval_duration'): metrics.prompt_eval_seconds.labels(model).observe(stats['prompt_eval_duration'] / 1e9)
+    if stats.get('prompt_eval_count'):
+        metrics.prompt_eval_tokens.labels(model).inc(stats['prompt_eval_count'])
+        if prompt_tokens: metrics.prompt_eval_share.labels(model).observe(stats['prompt_eval_count'] / prompt_tokens)
+    if stats.get('eval_count'):
+        metrics.eval_tokens.labels(model).inc(stats['eval_count'])
+        if stats.get('eval_duration'): metrics.eval_tokens_per_second.labels(model).observe(stats['eval_count'] / (stats['eval_duration'] / 1e9))
+    report = {'first_chunk_ms': round((parser.first_chunk_at - opened_at) * 1000) if parser.first_chunk_at else None, 'prompt_tokens_estimated': prompt_tokens}
+    for key in ('load_duration', 'prompt_eval_duration', 'eval_duration', 'total_duration'):
+        if key in stats: report[key.replace('_duration', '_ms')] = round(stats[key] / 1e6)
+    for key in ('prompt_eval_count', 'eval_count'):
+        if key in stats: report[key] = stats[key]
+    log.info("Chat stream finished", extra={'fields': {'model': model, 'error': parser.error, 'chars': len(parser.content), 'frames': frames, **report}})
+    return report
+def save_assistant_reply(session_id, thread_id, message_id, content, model=None, thinking=None):
+    assistant_message = { "id": message_id, "role": "assistant", "content": content, "thinking": thinking }
+    history = history_cache.get(session_id, thread_id)
+    history.append(assistant_message)
+    log.debug(f"Appended assistant msg {message_id} to thread {thread_id}")
+    thread = threads.touch(session_id, thread_id)
+    saved = persist(store.write_messages, session_id, thread_id, len(history) - 1, [assistant_message], thread)
+    if model: queue_title_if_needed(session_id, thread_id, history, model)
+    return saved
 @app.route('/api/chat', methods=['POST'])
 def chat():
     session_id, thread_id = get_session_data()
     try:
-        data = request.json
-        model = data.get('model')
-        frontend_messages = data.get('messages', [])
-        references = data.get('references', [])
-        system_prompt = data.get('systemPrompt', 'You are a helpful assistant.')
-        file_context_intro = data.get('fileContextIntro', DEFAULT_FILE_CONTEXT_INTRO)
-        append_context = data.get('appendContext', False) # Default to False (prepend)
-        if not model: return jsonify({"error": "Model is required"}), 400
-        if not frontend_messages: return jsonify({"error": "Messages are required"}), 400
-        context_prefix = ""
-        if references:
-            context_parts = []
-            for ref in references:
-                safe_ref = secure_filename(ref)
-                if safe_ref != ref: print(f"Warning: Skipped unsafe filename: {ref}"); continue
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_ref)
-                if os.path.exists(file_path) and allowed_file(safe_ref):
-                    try:
-                        with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                            content = file.read()
-                            # Format file content without the intro sentence here
-                            context_parts.append(f"--- File: {safe_ref} ---\n{content}\n--- End File: {safe_ref} ---")
-                    except Exception as e: print(f"Error reading ref {safe_ref}: {e}")
-                else: print(f"Ref not found/allowed: {ref}")
-
-            if context_parts:
-                # Construct the full prefix using the user's intro sentence
-                context_prefix = f"{file_context_intro}\n" + "\n".join(context_parts)
-        ollama_messages = []
-        persistent_messages = []
-        if system_prompt: ollama_messages.append({"role": "system", "content": system_prompt})
-        for i, msg in enumerate(frontend_messages):
-            if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg: continue
-            role = msg['role']
-            if role not in ['user', 'assistant']: continue
-
-            original_content = msg['content'] # Keep original content for saving
-            ollama_content = original_content # Start with original content for Ollama message
-
-            # --- Apply File Context based on settings ---
-            is_last_user_message = (i == len(frontend_messages) - 1 and role == 'user')
-            if is_last_user_message and context_prefix:
-                if append_context:
-                    # Append context *after* user message
-                    ollama_content = f"{original_content}\n\n{context_prefix}"
-                    print(f"Appending file context for message {i}")
-                else:
-                    # Prepend context *before* user message (default)
-                    ollama_content = f"{context_prefix}\n\n{original_content}"
-                    print(f"Prepending file context for message {i}")
-            # --- End Apply File Context ---
-
-            ollama_messages.append({"role": role, "content": ollama_content})
-
-            # --- Prepare message for saving (use original content) ---
-            persistent_msg = {
-                "id": msg.get('id') if msg.get('id') and not str(msg.get('id')).startswith('temp-') else str(uuid.uuid4()),
-                "role": role,
-                "content": original_content, # Save the user's text without the prepended/appended context
-                "referencedFiles": msg.get('referencedFiles', []) if role == 'user' else None # Save referenced files with user message
-            }
-            # Only include thinking if it exists and is not None
-            if 'thinking' in msg and msg['thinking'] is not None:
-                persistent_msg['thinking'] = msg['thinking']
-
-            # Remove referencedFiles key if it's None (for assistant messages)
-            if persistent_msg.get("referencedFiles") is None:
-                del persistent_msg["referencedFiles"]
-
-            persistent_messages.append(persistent_msg)
-            # --- End Prepare message for saving ---
-
-
-        # Save the history *before* sending to Ollama, using the persistent_messages
-        conversations[session_id][thread_id] = persistent_messages
-        print(f"Saved frontend history (len {len(persistent_messages)}) for thread {thread_id} before Ollama call")
-        for thread in threads.get(session_id, []):
-            if thread['id'] == thread_id: thread['updated_at'] = datetime.now().isoformat(); break
-        if not save_data(): return jsonify({"error": "Failed to save state before chat"}), 500
+        payload, context_report, error = prepare_chat(session_id, thread_id, request.json)
+        if error: return jsonify({"error": error[0]}), error[1]
+        model = payload['model']
 
         # --- Send to Ollama ---
-        ollama_url = os.environ.get('OLLAMA_API_URL', 'http://localhost:11434')
-        payload = { "model": model, "messages": ollama_messages, "stream": True } # Use the modified ollama_messages
-        print(f"Sending request to Ollama ({model})...")
-        try:
-            response = requests.post(f'{ollama_url}/api/chat', json=payload, stream=True, timeout=5000)
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:
-             print(f"Error calling Ollama /api/chat: {e}")
-             return jsonify({"error": f"Failed to connect to Ollama chat API: {e}"}), 503
+        response = None
+        slot_held = False
+        opened_at = None
+        def open_stream():
+            nonlocal opened_at
+            log.debug("Sending request to Ollama (%s)", model)
+            opened_at = time.monotonic()
+            upstream = ollama_client.post('chat', json=payload, stream=True)
+            upstream.raise_for_status()
+            metrics.active_streams.labels(model).inc()
+            return upstream
+        def release_stream():
+            nonlocal response, slot_held
+            if response is not None:
+                response.close(); response = None; log.debug("Ollama response closed.")
+                metrics.active_streams.labels(model).dec()
+            if slot_held: generation_limiter.release(model); slot_held = False
+        if generation_limiter.try_acquire(model):
+            slot_held = True
+            try: response = open_stream()
+            except requests.exceptions.RequestException as e:
+                release_stream()
+                log.error(f"Error calling Ollama /api/chat: {e}")
+                return jsonify({"error": f"Failed to connect to Ollama chat API: {e}"}), 503
         def generate():
-            assistant_response_content = ""
-            assistant_response_thinking = ""
-            has_thinking_tag = False
-            error_occurred = False
-            assistant_message_id = str(uuid.uuid4())
+            nonlocal response, slot_held
+            parser = ChatStreamParser()
+            coalescer = SSECoalescer()
             try:
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            chunk = json.loads(line.decode('utf-8'))
-                            if chunk.get('error'):
-                                print(f"Ollama error: {chunk['error']}")
-                                yield f"data: {json.dumps({'error': chunk['error']})}\n\n"; error_occurred = True; break
-                            if 'message' in chunk and 'content' in chunk['message']:
-                                content_part = chunk['message']['content']
-                                assistant_response_content += content_part
-                                yield f"data: {json.dumps({'content': content_part})}\n\n"
-                            if chunk.get('done', False) and chunk.get('total_duration'):
-                                print("Ollama stream finished."); break
-                        except json.JSONDecodeError: print(f"Warning: JSON decode failed: {line}")
-                        except Exception as e: print(f"Error processing chunk: {e}"); traceback.print_exc(); yield f"data: {json.dumps({'error': 'Stream processing error'})}\n\n"; error_occurred = True; break
-                if not error_occurred and assistant_response_content:
-                    final_content = assistant_response_content
-                    if '</think>' in assistant_response_content:
-                        parts = assistant_response_content.split('</think>', 1)
-                        assistant_response_thinking = parts[0].replace('<think>', '').strip()
-                        final_content = parts[1].strip(); has_thinking_tag = True
-                    assistant_message = { "id": assistant_message_id, "role": "assistant", "content": final_content, "thinking": assistant_response_thinking if has_thinking_tag else None }
-                    conversations[session_id][thread_id].append(assistant_message)
-                    print(f"Appended assistant msg {assistant_message_id} to thread {thread_id}")
-                    for thread in threads.get(session_id, []):
-                        if thread['id'] == thread_id: thread['updated_at'] = datetime.now().isoformat(); break
-                    save_data()
-                yield f"data: {json.dumps({'done': True})}\n\n"
+                yield sse({'context': context_report})
+                if not slot_held:
+                    # Over the per-model limit: report our place in the queue until a slot frees up
+                    queued_at = time.monotonic()
+                    try:
+                        with closing(generation_limiter.wait(model)) as queue:
+                            for position in queue:
+                                yield sse({'queue_position': position})
+                    except QueueFull:
+                        log.warning(f"Generation queue for {model} is full")
+                        yield sse({'error': f'Too many requests queued for {model}, try again later', 'done': True}); return
+                    metrics.queue_wait_seconds.labels(model).observe(time.monotonic() - queued_at)
+                    slot_held = True
+                    try: response = open_stream()
+                    except requests.exceptions.RequestException as e:
+                        log.error(f"Error calling Ollama /api/chat: {e}")
+                        yield sse({'error': f'Failed to connect to Ollama chat API: {e}', 'done': True}); return
+                # Wakes up when buffered text is due even if Ollama sends nothing more for a while
+                for line in iter_with_timeouts(response.iter_lines(), coalescer.wait_time):
+                    if line is None:
+                        frames = coalescer.due()
+                        if frames: yield frames
+                        continue
+                    if not line: continue
+                    try: frames = coalescer.add(parser.feed(line))
+                    except Exception as e:
+                        log.exception(f"Error processing chunk: {e}")
+                        parser.error = 'Stream processing error'; yield coalescer.add([{'error': parser.error}]); break
+                    if frames: yield frames
+                    if parser.finished: break
+                tail = coalescer.flush()
+                if tail: yield tail
+                timings = record_stream_metrics(model, opened_at, parser, coalescer.frames, context_report['prompt_tokens'])
+                if not parser.error and (parser.content or parser.thinking):
+                    save_assistant_reply(session_id, thread_id, str(uuid.uuid4()), parser.content, model, parser.thinking)
+                yield sse({'stats': timings, 'done': True})
             except Exception as e:
-                print(f"Error during stream generation: {e}"); traceback.print_exc()
-                try: yield f"data: {json.dumps({'error': f'Streaming error: {e}', 'done': True})}\n\n"
-                except Exception as yield_e: print(f"Error sending final error: {yield_e}")
-            finally: response.close(); print("Ollama response closed.")
-        return app.response_class(stream_with_context(generate()), mimetype='text/event-stream')
+                log.exception(f"Error during stream generation: {e}")
+                try: yield sse({'error': f'Streaming error: {e}', 'done': True})
+                except Exception as yield_e: log.error(f"Error sending final error: {yield_e}")
+            finally: release_stream()
+        streamed_response = app.response_class(stream_with_context(generate()), mimetype='text/event-stream')
+        streamed_response.call_on_close(release_stream)
+        return streamed_response
     except Exception as e:
-        print(f"--- Error in /api/chat ---"); traceback.print_exc(); print(f"-------------------------")
+        log.exception("Error in /api/chat")
         return jsonify({"error": f"Unexpected server error: {str(e)}"}), 500
 @app.route('/api/generate-title', methods=['POST'])
 def generate_title():
+    # Titles are generated in the background; clients pick up the new name from /api/threads
     session_id, thread_id = get_session_data()
-    try:
-        data = request.json
-        messages = data.get('messages', [])
-        selected_model = data.get('model')
-        if not messages:
-            return jsonify({"success": False, "error": "No messages provided"}), 400
-        if not selected_model:
-            return jsonify({"success": False, "error": "Model not specified"}), 400
-        max_snippet = 6
-        snippet_messages = messages[:max_snippet//2] + messages[-max_snippet//2:] if len(messages) > max_snippet else messages
-        snippet = "Snippet:\n"
-        for msg in snippet_messages:
-            role = "User" if msg.get("role") == "user" else "Assistant"
-            content = msg.get('content', '')[:150] + ('...' if len(msg.get('content', '')) > 150 else '')
-            snippet += f"{role}: {content}\n"
-        system_prompt = "Generate a concise, specific title (max 8 words) for the conversation snippet. Focus on the core topic. Avoid generic terms. Output ONLY the title."
-        print(f"--- Generating Title for {thread_id} ({selected_model}) ---")
-        ollama_url = os.environ.get('OLLAMA_API_URL', 'http://localhost:11434')
-        response = requests.post(
-            f'{ollama_url}/api/generate',
-            json={
-                "model": selected_model,
-                "system": system_prompt,
-                "prompt": snippet,
-                "stream": False,
-            },
-        )
-        response.raise_for_status() 
-        response_data = response.json()
-        full_title_response = response_data.get("response", "").strip()
-        if not full_title_response:
-            print("Ollama returned empty title response.")
-            return jsonify({"success": True, "title": "Chat Summary"})
-        actual_title = full_title_response
-        if '</think>' in full_title_response:
-            parts = full_title_response.split('</think>', 1)
-            if len(parts) > 1:
-                actual_title = parts[1].strip()
-                print(f"Stripped thinking part from title. Raw: '{full_title_response}', Using: '{actual_title}'")
-            else:
-                actual_title = "" 
-                print(f"Warning: Found '</think>' but couldn't properly extract title content: '{full_title_response}'")
-        if not actual_title:
-             print("Title content became empty after stripping think tags or was originally empty.")
-             return jsonify({"success": True, "title": "Chat Summary"}) 
-        title = re.sub(r'<.*?>', '', actual_title)
-        title = re.sub(r'^\W+|\W+$', '', title)
-        title = re.sub(r'\s+', ' ', title).strip()
-        if title:
-            title = title[0].upper() + title[1:]
-            print(f"Generated title: '{title}'")
-            return jsonify({"success": True, "title": title})
-        else:
-            print("Title became empty after cleaning. Using fallback.")
-            return jsonify({"success": True, "title": "Chat Summary"})
-    except requests.exceptions.RequestException as e:
-        print(f"Ollama title generation request error: {e}")
-        return jsonify({"success": False, "error": f"Ollama connection error during title generation: {e}"}), 503
-    except Exception as e:
-        print(f"--- Error in generate_title ---")
-        traceback.print_exc()
-        return jsonify({"success": False, "error": "Internal server error during title generation"}), 500
+    data = request.json or {}
+    messages = data.get('messages') or history_cache.get(session_id, thread_id)
+    selected_model = data.get('model')
+    if not messages:
+        return jsonify({"success": False, "error": "No messages provided"}), 400
+    if not selected_model:
+        return jsonify({"success": False, "error": "Model not specified"}), 400
+    title_queue.submit(session_id, thread_id, messages, selected_model)
+    return jsonify({"success": True, "queued": True, "thread_id": thread_id}), 202
 @app.route('/api/upload', methods=['POST'])
 def api_upload_file():
+    # Accepts a multipart form with a `file` field, or the raw file as the request body with ?filename=...
     session_id, _ = get_session_data()
-    if 'file' not in request.files: return jsonify({"error": "No file part"}), 400
-    file = request.files['file']
-    if file.filename == '': return jsonify({"error": "No selected file"}), 400
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        upload_folder = app.config['UPLOAD_FOLDER']; os.makedirs(upload_folder, exist_ok=True)
-        save_path = os.path.join(upload_folder, filename)
-        try: file.save(save_path); print(f"Uploaded: {filename} (Session: {session_id})"); return jsonify({"success": True, "filename": filename}), 200
-        except Exception as e: print(f"Error saving {filename}: {e}"); traceback.print_exc(); return jsonify({"error": f"Save error: {e}"}), 500
-    else: print(f"File type not allowed: {file.filename}"); return jsonify({"error": "File type not allowed"}), 400
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD: return upload_too_large()
+    if request.mimetype == 'multipart/form-data':
+        if 'file' not in request.files: return jsonify({"error": "No file part"}), 400
+        original_name, stream = request.files['file'].filename, request.files['file'].stream
+    else: original_name, stream = request.args.get('filename', ''), request.stream
+    if not original_name: return jsonify({"error": "No selected file"}), 400
+    filename = secure_filename(original_name)
+    if not filename or not allowed_file(filename): log.warning(f"File type not allowed: {original_name}"); return jsonify({"error": "File type not allowed"}), 400
+    try: sha256, size = documents.blobs.save_stream(stream, MAX_UPLOAD_BYTES)
+    except (UploadTooLarge, RequestEntityTooLarge): return upload_too_large()
+    except Exception as e: log.exception(f"Error saving {filename}: {e}"); return jsonify({"error": f"Save error: {e}"}), 500
+    previous = files.get(session_id, filename, shared=False)
+    entry = {'name': filename, 'sha256': sha256, 'size': size, 'uploaded_at': datetime.now().isoformat()}
+    if not persist(store.save_file, session_id, entry): return jsonify({"error": "Failed to save file record"}), 500
+    files.put(session_id, entry)
+    if previous and previous['sha256'] != sha256: release_blob(previous['sha256'])
+    log.info(f"Uploaded: {filename} ({size} bytes, {sha256[:12]}) (Session: {session_id})")
+    try: document = documents.ensure(sha256, filename)
+    except Exception as e: log.exception(f"Error extracting {filename}: {e}"); document = None
+    return jsonify({"success": True, "filename": filename, "document": document}), 200
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e=None):
+    # Raised by Werkzeug while parsing a body over MAX_CONTENT_LENGTH (e.g. request.files)
+    return jsonify({"error": f"File is larger than {MAX_UPLOAD_BYTES / 2**20:g} MB"}), 413
 @app.route('/api/files', methods=['GET'])
-def get_files_list(): return jsonify(get_uploaded_files())
+def get_files_list(): return jsonify(files.names(session['session_id']))
 @app.route('/api/files/<path:filename>', methods=['DELETE'])
 def delete_file_api(filename):
     session_id, _ = get_session_data()
-    safe_filename = secure_filename(filename)
-    if not safe_filename or safe_filename != filename: return jsonify({"error": "Invalid filename"}), 400
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
-    if not os.path.exists(file_path): return jsonify({"error": "File not found"}), 404
-    if not os.path.isfile(file_path): return jsonify({"error": "Invalid path"}), 400
-    try: os.remove(file_path); print(f"Deleted file: {safe_filename} (Session: {session_id})"); return jsonify({"success": True}), 200
-    except Exception as e: print(f"Error deleting {safe_filename}: {e}"); traceback.print_exc(); return jsonify({"error": f"Delete error: {e}"}), 500
+    owner = files.owner(session_id, filename)
+    if owner is None: return jsonify({"error": "File not found"}), 404
+    entry = files.get(owner, filename, shared=False)
+    if not persist(store.delete_file, owner, filename): return jsonify({"error": "Delete error"}), 500
+    files.remove(owner, filename)
+    release_blob(entry['sha256'])
+    log.info(f"Deleted file: {filename} (Session: {session_id})")
+    return jsonify({"success": True}), 200
 @app.route('/api/conversation/clear', methods=['POST'])
 def clear_conversation():
     session_id, thread_id = get_session_data()
     thread_cleared = False
     title_reset = False
-    if thread_id in conversations.get(session_id, {}):
-        conversations[session_id][thread_id] = []
-        print(f"Cleared messages for thread {thread_id} (Session: {session_id})")
+    thread = find_thread(session_id, thread_id)
+    if thread:
+        history_cache.put(session_id, thread_id, [])
+        log.info(f"Cleared messages for thread {thread_id} (Session: {session_id})")
         thread_cleared = True
-    session_threads = threads.get(session_id, [])
-    for thread in session_threads:
-        if thread['id'] == thread_id:
-            if thread['name'] != DEFAULT_THREAD_NAME:
-                 thread['name'] = DEFAULT_THREAD_NAME
-                 thread['updated_at'] = datetime.now().isoformat()
-                 title_reset = True
-                 print(f"Reset title for thread {thread_id}")
-            break
+    if thread and thread['name'] != DEFAULT_THREAD_NAME:
+        threads.touch(session_id, thread_id)
+        thread['name'] = DEFAULT_THREAD_NAME
+        title_reset = True
+        log.info(f"Reset title for thread {thread_id}")
     if thread_cleared or title_reset:
-        if save_data(): return jsonify({"success": True}), 200
+        if persist(store.write_messages, session_id, thread_id, 0, [], thread if title_reset else None): return jsonify({"success": True}), 200
         else: return jsonify({"error": "Failed to save cleared conversation/title"}), 500
     else:
-        print(f"Attempted to clear non-existent or already cleared/default thread {thread_id}")
+        log.debug(f"Attempted to clear non-existent or already cleared/default thread {thread_id}")
         return jsonify({"success": True}), 200
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run Ollama Chat interface')
@@ -470,10 +644,11 @@ if __name__ == '__main__':
     parser.add_argument('--port', type=int, default=5000, help='Port (default: 5000)')
     parser.add_argument('--debug', action='store_true', help='Enable Flask debug mode')
     parser.add_argument('--reload', action='store_true', help='Enable auto-reloader (implies debug)')
+    parser.add_argument('--import-json', action='store_true', help='Re-import data/conversations.json and data/threads.json into the store')
     args = parser.parse_args()
-    load_data()
+    load_data(force_import=args.import_json)
     use_reloader = args.reload or args.debug
-    print(f"Starting Flask server on {args.host}:{args.port} | Debug: {args.debug} | Reload: {use_reloader}")
-    print(f"Uploads: {os.path.abspath(app.config['UPLOAD_FOLDER'])} | Data: {os.path.abspath(app.config['DATA_FOLDER'])}")
-    print(f"Ollama URL: {os.environ.get('OLLAMA_API_URL', 'http://localhost:11434')}")
+    log.info(f"Starting Flask server on {args.host}:{args.port} | Debug: {args.debug} | Reload: {use_reloader}")
+    log.info(f"Uploads: {os.path.abspath(app.config['UPLOAD_FOLDER'])} | Data: {os.path.abspath(app.config['DATA_FOLDER'])}")
+    log.info(f"Ollama URL: {ollama_client.base_url()}")
     app.run(host=args.host, port=args.port, debug=args.debug, use_reloader=use_reloader)
@@ -0,0 +1,186 @@
+import os
+import json
+import uuid
+import time
+import asyncio
+from contextlib import aclosing
+from http.cookies import SimpleCookie
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+import ollama_client
+from ollama_client import AsyncGenerationLimiter, QueueFull, TIMEOUTS, POOL_SIZE
+from app import app as flask_app, load_data, find_thread, prepare_chat, save_assistant_reply, record_stream_metrics, title_queue, cache_sync
+from streaming import ChatStreamParser, SSECoalescer, aiter_with_timeouts, sse
+import metrics
+from logs import get_logger
+log = get_logger('asgi')
+# Async entry point: /api/chat streams are served on the event loop, everything else goes to the Flask app.
+# Run with: uvicorn asgi:app --host 127.0.0.1 --port 5000
+wsgi_app = WsgiToAsgi(flask_app)
+limiter = AsyncGenerationLimiter(
+    max_per_model=int(os.environ.get('KITT_MAX_GENERATIONS_PER_MODEL', '2')),
+    max_queue=int(os.environ.get('KITT_MAX_QUEUE_PER_MODEL', '32')))
+# Chats are limited here rather than by the Flask app's limiter, so titles must yield to this one
+title_queue.is_busy = lambda: limiter.active() + limiter.queued() > 0
+http = None
+def get_http():
+    global http
+    if http is None:
+        connect, read = TIMEOUTS['chat']
+        http = httpx.AsyncClient(
+            timeout=httpx.Timeout(connect=connect, read=read, write=connect, pool=None),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=POOL_SIZE))
+    return http
+def read_session(scope):
+    # Decodes Flask's signed session cookie; returns (session_id, active_thread) or None.
+    headers = dict(scope.get('headers', []))
+    cookies = SimpleCookie(headers.get(b'cookie', b'').decode('latin-1'))
+    morsel = cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if morsel is None: return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try: data = serializer.loads(morsel.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except Exception: return None
+    if not data.get('session_id') or not data.get('active_thread'): return None
+    return data['session_id'], data['active_thread']
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect': return None
+        body += message.get('body', b'')
+        if not message.get('more_body'): return body
+def replay(body, receive):
+    sent = False
+    async def replay_receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return await receive()
+    return replay_receive
+async def send_json(send, data, status):
+    body = json.dumps(data).encode()
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+async def open_stream(payload):
+    log.debug("Sending request to Ollama (%s)", payload['model'])
+    request = get_http().build_request('POST', f'{ollama_client.base_url()}/api/chat', json=payload)
+    response = await get_http().send(request, stream=True)
+    if response.is_error:
+        await response.aread(); await response.aclose()
+        response.raise_for_status()
+    metrics.active_streams.labels(payload['model']).inc()
+    return response
+def timed(send, started):
+    # Records the time to response headers for /api/chat, like the Flask app does for its routes
+    async def timed_send(message):
+        if message['type'] == 'http.response.start':
+            metrics.request_duration.labels('POST', '/api/chat', message['status']).observe(time.perf_counter() - started)
+        await send(message)
+    return timed_send
+async def chat(scope, receive, send):
+    started = time.perf_counter()
+    body = await read_body(receive)
+    if body is None: return
+    session_ids = read_session(scope)
+    await asyncio.to_thread(cache_sync.poll)  # may wait for a poll running in another thread
+    if session_ids is None or find_thread(*session_ids) is None:
+        # No usable session yet: let the Flask route create one
+        await wsgi_app(scope, replay(body, receive), send); return
+    session_id, thread_id = session_ids
+    send = timed(send, started)
+    try:
+        payload, context_report, error = await asyncio.to_thread(prepare_chat, session_id, thread_id, json.loads(body or b'{}'))
+    except Exception as e:
+        log.exception("Error in /api/chat")
+        await send_json(send, {"error": f"Unexpected server error: {str(e)}"}, 500); return
+    if error: await send_json(send, {"error": error[0]}, error[1]); return
+    model = payload['model']
+    response = None
+    slot_held = limiter.try_acquire(model)
+    opened_at = time.monotonic()
+    if slot_held:
+        try: response = await open_stream(payload)
+        except httpx.HTTPError as e:
+            await limiter.release(model)
+            log.error(f"Error calling Ollama /api/chat: {e}")
+            await send_json(send, {"error": f"Failed to connect to Ollama chat API: {e}"}, 503); return
+    async def emit(event):
+        await write(sse(event))
+    async def write(text):
+        if text: await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+    async def stream():
+        nonlocal response, slot_held, opened_at
+        parser = ChatStreamParser()
+        coalescer = SSECoalescer()
+        try:
+            await emit({'context': context_report})
+            if not slot_held:
+                # Over the per-model limit: report our place in the queue until a slot frees up
+                try:
+                    async with aclosing(limiter.wait(model)) as queue:
+                        async for position in queue: await emit({'queue_position': position})
+                except QueueFull:
+                    log.warning(f"Generation queue for {model} is full")
+                    await emit({'error': f'Too many requests queued for {model}, try again later', 'done': True}); return
+                metrics.queue_wait_seconds.labels(model).observe(time.monotonic() - opened_at)
+                slot_held = True
+                opened_at = time.monotonic()
+                try: response = await open_stream(payload)
+                except httpx.HTTPError as e:
+                    log.error(f"Error calling Ollama /api/chat: {e}")
+                    await emit({'error': f'Failed to connect to Ollama chat API: {e}', 'done': True}); return
+            async with aclosing(aiter_with_timeouts(response.aiter_lines(), coalescer.wait_time)) as lines:
+                async for line in lines:
+                    # None: Ollama is pausing, send the buffered text that is due
+                    if line is None: await write(coalescer.due()); continue
+                    if not line: continue
+                    try: frames = coalescer.add(parser.feed(line))
+                    except Exception as e:
+                        log.exception(f"Error processing chunk: {e}")
+                        parser.error = 'Stream processing error'; await write(coalescer.add([{'error': parser.error}])); break
+                    await write(frames)
+                    if parser.finished: break
+            await write(coalescer.flush())
+            timings = record_stream_metrics(model, opened_at, parser, coalescer.frames, context_report['prompt_tokens'])
+            if not parser.error and (parser.content or parser.thinking):
+                await asyncio.to_thread(save_assistant_reply, session_id, thread_id, str(uuid.uuid4()), parser.content, model, parser.thinking)
+            await emit({'stats': timings, 'done': True})
+        except asyncio.CancelledError: raise
+        except Exception as e:
+            log.exception(f"Error during stream generation: {e}")
+            await emit({'error': f'Streaming error: {e}', 'done': True})
+        finally:
+            if response is not None:
+                await response.aclose(); log.debug("Ollama response closed.")
+                metrics.active_streams.labels(model).dec()
+            if slot_held: await limiter.release(model)
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect': pass
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]})
+    stream_task = asyncio.create_task(stream())
+    disconnect_task = asyncio.create_task(wait_for_disconnect())
+    try:
+        done, _ = await asyncio.wait({stream_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (stream_task, disconnect_task):
+            if not task.done(): task.cancel()
+        await asyncio.gather(stream_task, disconnect_task, return_exceptions=True)
+    if disconnect_task in done:
+        log.info(f"Client disconnected, cancelled Ollama request for thread {thread_id}")
+    else:
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            load_data()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if http is not None: await http.aclose()
+            await send({'type': 'lifespan.shutdown.complete'}); return
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan': await lifespan(receive, send); return
+    if scope['type'] == 'http' and scope['path'] == '/api/chat' and scope['method'] == 'POST':
+        await chat(scope, receive, send); return
+    await wsgi_app(scope, receive, send)
@@ -0,0 +1,130 @@
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+# A stand-in for the Ollama endpoints KITT uses (/api/tags, /api/show, /api/chat, /api/generate).
+# Replies are deterministic and streamed at a fixed token rate, so any time beyond that is KITT's own.
+WORDS = "the quick brown fox jumps over a lazy dog while seven wizards quietly box with jovial kings".split()
+MARKER = re.compile(r'\[bench:([\w.-]+)\]')
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    def handle_error(self, request, client_address):
+        # KITT's pooled keep-alive connections are reset when the server under test stops
+        if not isinstance(sys.exc_info()[1], ConnectionError): super().handle_error(request, client_address)
+class MockOllama:
+    def __init__(self, host='127.0.0.1', port=0, models=('bench:latest',), num_ctx=8192,
+                 tokens_per_second=200.0, chunk_tokens=1, reply_tokens=64, think_tokens=0, first_token_delay=0.05):
+        self.models = list(models)
+        self.num_ctx = num_ctx
+        self.tokens_per_second = tokens_per_second
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.reply_tokens = reply_tokens
+        self.think_tokens = think_tokens
+        self.first_token_delay = first_token_delay
+        self.calls = {}  # endpoint -> count
+        self.streams = {}  # bench marker -> upstream timings (time.monotonic())
+        self._lock = threading.Lock()
+        self.server = _Server((host, port), self._handler())
+        self._thread = None
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='mock-ollama', daemon=True)
+        self._thread.start()
+        return self
+    def stop(self):
+        self.server.shutdown(); self.server.server_close()
+    def reply_chunks(self):
+        # (content, token count) per NDJSON line: an optional <think> section, then the answer
+        tokens = [f'{WORDS[i % len(WORDS)]} ' for i in range(self.think_tokens)]
+        if tokens: tokens = ['<think>'] + tokens + ['</think>']
+        tokens += [f'{WORDS[(i * 7) % len(WORDS)]} ' for i in range(self.reply_tokens)]
+        for i in range(0, len(tokens), self.chunk_tokens):
+            part = tokens[i:i + self.chunk_tokens]
+            yield ''.join(part), len(part)
+    def _count(self, endpoint):
+        with self._lock: self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+    def _handler(self):
+        mock = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def log_message(self, *args): pass
+            def send_json(self, body, status=200):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers(); self.wfile.write(data)
+            def send_chunk(self, body):
+                data = (json.dumps(body) + '\n').encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data)); self.wfile.flush()
+            def do_GET(self):
+                mock._count(self.path)
+                if self.path == '/api/tags':
+                    self.send_json({'models': [{'name': name, 'model': name, 'digest': f'bench-{name}', 'size': 1, 'modified_at': '2024-01-01T00:00:00Z'} for name in mock.models]})
+                else: self.send_json({'error': 'not found'}, 404)
+            def do_POST(self):
+                mock._count(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                if self.path == '/api/show':
+                    self.send_json({'model_info': {'bench.context_length': mock.num_ctx}, 'details': {'parameter_size': '1B', 'family': 'bench'}})
+                elif self.path == '/api/generate':
+                    if body.get('format') == 'json':
+                        count = len(re.findall(r'^\d+\. Snippet:', body.get('prompt', ''), re.M))
+                        self.send_json({'response': json.dumps({'titles': [f'Bench title {i}' for i in range(1, count + 1)]}), 'done': True})
+                    else: self.send_json({'response': 'Bench title', 'done': True})
+                elif self.path == '/api/chat': self.stream_chat(body)
+                else: self.send_json({'error': 'not found'}, 404)
+            def stream_chat(self, body):
+                received_at = time.monotonic()
+                messages = body.get('messages') or []
+                match = MARKER.search(messages[-1].get('content', '')) if messages else None
+                prompt_chars = sum(len(m.get('content') or '') for m in messages)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                time.sleep(mock.first_token_delay)
+                first_chunk_at, eval_count = None, 0
+                try:
+                    for content, tokens in mock.reply_chunks():
+                        if first_chunk_at is None: first_chunk_at = time.monotonic()
+                        self.send_chunk({'model': body.get('model'), 'message': {'role': 'assistant', 'content': content}, 'done': False})
+                        eval_count += tokens
+                        if mock.tokens_per_second > 0: time.sleep(tokens / mock.tokens_per_second)
+                    finished_at = time.monotonic()
+                    prompt_eval = (first_chunk_at or finished_at) - received_at
+                    self.send_chunk({'model': body.get('model'), 'message': {'role': 'assistant', 'content': ''}, 'done': True,
+                                     'total_duration': int((finished_at - received_at) * 1e9), 'load_duration': 0,
+                                     'prompt_eval_count': prompt_chars // 4, 'prompt_eval_duration': int(prompt_eval * 1e9),
+                                     'eval_count': eval_count, 'eval_duration': int((finished_at - (first_chunk_at or finished_at)) * 1e9)})
+                    self.wfile.write(b'0\r\n\r\n'); self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError): finished_at = None
+                if match:
+                    with mock._lock:
+                        mock.streams[match.group(1)] = {'received_at': received_at, 'first_chunk_at': first_chunk_at,
+                                                        'finished_at': finished_at, 'prompt_chars': prompt_chars}
+        return Handler
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a mock Ollama server for benchmarks and offline development')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--models', default='bench:latest', help='Comma-separated model names')
+    parser.add_argument('--tokens-per-second', type=float, default=200.0, help='Generation speed, 0 for as fast as possible')
+    parser.add_argument('--chunk-tokens', type=int, default=1, help='Tokens per streamed line')
+    parser.add_argument('--reply-tokens', type=int, default=64)
+    parser.add_argument('--think-tokens', type=int, default=0, help='Length of a <think> section before the reply')
+    parser.add_argument('--first-token-delay', type=float, default=0.05, help='Seconds of simulated prompt processing')
+    parser.add_argument('--num-ctx', type=int, default=8192)
+    args = parser.parse_args()
+    mock = MockOllama(args.host, args.port, args.models.split(','), args.num_ctx, args.tokens_per_second,
+                      args.chunk_tokens, args.reply_tokens, args.think_tokens, args.first_token_delay)
+    print(f"Mock Ollama on {mock.url} (set OLLAMA_API_URL={mock.url})")
+    try: mock.server.serve_forever()
+    except KeyboardInterrupt: pass
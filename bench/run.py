@@ -0,0 +1,304 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from mock_ollama import MockOllama
+# Load and latency benchmark: runs KITT against bench/mock_ollama.py with many concurrent sessions and reports the
+# time KITT adds on top of the (simulated) model, SSE throughput, persistence cost and memory per session.
+# Runs offline; see bench/README.md.
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+SERVERS = {
+    'flask': [sys.executable, os.path.join(REPO, 'app.py'), '--port', '{port}'],
+    'gunicorn': [sys.executable, '-m', 'gunicorn', '--worker-class', 'gthread', '--workers', '{workers}', '--threads', '{threads}', '--bind', '127.0.0.1:{port}', 'wsgi:app'],
+    'uvicorn': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--app-dir', REPO, '--port', '{port}', '--log-level', 'warning'],
+}
+FILLER = "Please summarise the following notes and suggest next steps for the project plan. "
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+def percentile(values, q):
+    values = sorted(v for v in values if v is not None)
+    if not values: return None
+    return values[min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))]
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+def rss_kb(pid):
+    # Resident memory of the server and its worker processes, via ps so it works on Linux and macOS
+    try: out = subprocess.run(['ps', '-A', '-o', 'pid=,ppid=,rss='], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError): return None
+    rows = [tuple(int(x) for x in line.split()) for line in out.splitlines() if len(line.split()) == 3]
+    tree, changed = {pid}, True
+    while changed:
+        changed = False
+        for child, parent, _ in rows:
+            if parent in tree and child not in tree: tree.add(child); changed = True
+    return sum(rss for child, _, rss in rows if child in tree)
+def parse_metrics(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            try: samples[name] = float(value)
+            except ValueError: pass
+    return samples
+class Client:
+    # One browser: keeps the session cookie and a keep-alive connection
+    def __init__(self, port, timeout=120):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+        self.cookie = None
+    def request(self, method, path, body=None):
+        headers, data = {}, None
+        if body is not None: data = json.dumps(body).encode(); headers['Content-Type'] = 'application/json'
+        if self.cookie: headers['Cookie'] = self.cookie
+        self.conn.request(method, path, body=data, headers=headers)
+        response = self.conn.getresponse()
+        cookie = response.getheader('Set-Cookie')
+        if cookie: self.cookie = cookie.split(';', 1)[0]
+        return response
+    def timed_get(self, path):
+        started = time.monotonic()
+        response = self.request('GET', path)
+        response.read()
+        return time.monotonic() - started, response.status
+    def chat(self, model, content):
+        # Streams one reply and records when the headers, the first byte and the first token arrived
+        result = {'sent_at': time.monotonic(), 'first_byte_at': None, 'first_token_at': None, 'events': 0, 'token_events': 0, 'bytes': 0, 'error': None}
+        response = self.request('POST', '/api/chat', {'model': model, 'message': {'content': content}})
+        result['status'] = response.status
+        buffer = b''
+        while True:
+            data = response.read1(65536)
+            if not data: break
+            now = time.monotonic()
+            if result['first_byte_at'] is None: result['first_byte_at'] = now
+            result['bytes'] += len(data)
+            buffer += data
+            while b'\n\n' in buffer:
+                raw, buffer = buffer.split(b'\n\n', 1)
+                if not raw.startswith(b'data: '): continue
+                event = json.loads(raw[6:])
+                result['events'] += 1
+                if event.get('content') or event.get('thinking'):
+                    result['token_events'] += 1
+                    if result['first_token_at'] is None: result['first_token_at'] = now
+                if event.get('error'): result['error'] = event['error']
+        result['done_at'] = time.monotonic()
+        return result
+def run_session(port, index, args, turns_out, reads_out):
+    client = Client(port)
+    client.timed_get('/api/threads')  # creates the session and its first thread
+    for turn in range(args.turns):
+        marker = f's{index}t{turn}'
+        result = client.chat(args.model, f"[bench:{marker}] {FILLER * args.message_repeat}")
+        result.update(session=index, turn=turn, marker=marker)
+        turns_out.append(result)
+        for name, path in (('threads', '/api/threads'), ('history', '/api/conversation/history?limit=50')):
+            elapsed, status = client.timed_get(path)
+            reads_out.append({'name': name, 'turn': turn, 'seconds': elapsed, 'status': status})
+def start_server(args, mock_url, workdir):
+    port = free_port()
+    command = [part.format(port=port, workers=args.workers, threads=args.threads) for part in SERVERS[args.server]]
+    env = dict(os.environ, OLLAMA_API_URL=mock_url, PYTHONPATH=REPO, FLASK_SECRET_KEY='bench', KITT_LOG_LEVEL=args.log_level,
+               KITT_MAX_GENERATIONS_PER_MODEL=str(args.max_generations or args.sessions), KITT_MAX_QUEUE_PER_MODEL=str(max(32, args.sessions)))
+    log_file = open(os.path.join(workdir, 'server.log'), 'w')
+    # Run from the scratch directory so data/ and uploads/ start empty and the real store is untouched
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None: break
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/metrics')
+            if conn.getresponse().status == 200: return process, port
+        except OSError: time.sleep(0.2)
+    process.kill()
+    log_file.close()
+    with open(os.path.join(workdir, 'server.log')) as f: sys.exit(f"Server did not start:\n{f.read()[-4000:]}")
+def scrape_metrics(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', '/metrics')
+    return parse_metrics(conn.getresponse().read().decode())
+def run_load(args, mock, port, server_pid):
+    warmup = Client(port)
+    warmup.timed_get('/api/models')
+    warmup.chat(args.model, f"[bench:warmup] {FILLER}")
+    before_rss, before_metrics = rss_kb(server_pid), scrape_metrics(port)
+    turns, reads = [], []
+    workers = [threading.Thread(target=run_session, args=(port, i, args, turns, reads)) for i in range(args.sessions)]
+    started = time.monotonic()
+    for worker in workers: worker.start()
+    for worker in workers: worker.join()
+    wall = time.monotonic() - started
+    after_rss, after_metrics = rss_kb(server_pid), scrape_metrics(port)
+    return turns, reads, wall, (before_rss, after_rss), (before_metrics, after_metrics)
+def summarize_load(args, mock, turns, reads, wall, rss, scraped):
+    rows = []
+    for t in turns:
+        upstream = mock.streams.get(t['marker'])
+        if t['status'] != 200 or t['error'] or not upstream or upstream['finished_at'] is None: continue
+        rows.append({
+            'turn': t['turn'],
+            # Request parsing, session lookup, history load, context fitting and the store write before calling Ollama
+            'pre_upstream': upstream['received_at'] - t['sent_at'],
+            'first_byte': t['first_byte_at'] - t['sent_at'],
+            'first_token': t['first_token_at'] - t['sent_at'] if t['first_token_at'] else None,
+            'first_token_overhead': t['first_token_at'] - upstream['first_chunk_at'] if t['first_token_at'] and upstream['first_chunk_at'] else None,
+            # Saving the reply and closing the stream after Ollama finished
+            'post_stream': t['done_at'] - upstream['finished_at'],
+            'added': (t['done_at'] - t['sent_at']) - (upstream['finished_at'] - upstream['received_at']),
+            'total': t['done_at'] - t['sent_at'],
+            'events_per_second': t['token_events'] / (t['done_at'] - t['first_token_at']) if t['first_token_at'] and t['done_at'] > t['first_token_at'] else None,
+        })
+    summary = {'requests': len(turns), 'failed': len(turns) - len(rows), 'wall_seconds': round(wall, 3)}
+    for key in ('pre_upstream', 'first_byte', 'first_token', 'first_token_overhead', 'post_stream', 'added', 'total'):
+        for q in (50, 95, 99): summary[f'{key}_p{q}_ms'] = ms(percentile([r[key] for r in rows], q))
+    for name in ('threads', 'history'):
+        for q in (50, 95): summary[f'get_{name}_p{q}_ms'] = ms(percentile([r['seconds'] for r in reads if r['name'] == name], q))
+    summary['stream_events_per_second_p50'] = round(percentile([r['events_per_second'] for r in rows], 50) or 0, 1)
+    summary['sse_token_events_per_second'] = round(sum(t['token_events'] for t in turns) / wall, 1)
+    summary['sse_kib_per_second'] = round(sum(t['bytes'] for t in turns) / 1024 / wall, 1)
+    # How the per-request cost changes as each thread's history grows
+    buckets = {}
+    for r in rows: buckets.setdefault(min(3, r['turn'] * 4 // max(1, args.turns)), []).append(r)
+    summary['by_history_length'] = [{
+        'turns': f"{min(r['turn'] for r in bucket) + 1}-{max(r['turn'] for r in bucket) + 1}",
+        'pre_upstream_p50_ms': ms(percentile([r['pre_upstream'] for r in bucket], 50)),
+        'post_stream_p50_ms': ms(percentile([r['post_stream'] for r in bucket], 50)),
+    } for _, bucket in sorted(buckets.items())]
+    before, after = scraped
+    # /metrics is per process, so the store timings are only meaningful with a single worker
+    for operation in (('save_thread', 'write_messages') if args.server != 'gunicorn' or args.workers == 1 else ()):
+        count = after.get(f'kitt_store_write_seconds_count{{operation="{operation}"}}', 0) - before.get(f'kitt_store_write_seconds_count{{operation="{operation}"}}', 0)
+        total = after.get(f'kitt_store_write_seconds_sum{{operation="{operation}"}}', 0) - before.get(f'kitt_store_write_seconds_sum{{operation="{operation}"}}', 0)
+        summary[f'server_{operation}_mean_ms'] = ms(total / count) if count else None
+    if rss[0] and rss[1]:
+        summary['server_rss_mib'] = round(rss[1] / 1024, 1)
+        summary['rss_kib_per_session'] = round((rss[1] - rss[0]) / args.sessions, 1)
+    return summary
+def bench_store(sizes, workdir, thread_messages=20, samples=200, sessions=20):
+    # Persistence cost as the store grows, measured directly against storage.ConversationStore.
+    # Threads are spread over `sessions` users; searches cover one user's history.
+    from storage import ConversationStore
+    store = ConversationStore(os.path.join(workdir, 'store-bench.db'))
+    message = {'role': 'user', 'content': FILLER * 4}
+    thread_count, results = 0, []
+    def sid(n): return f'user{n % sessions}'
+    def thread(tid): return {'id': tid, 'name': 'Bench', 'created_at': '2024-01-01T00:00:00', 'updated_at': '2024-01-01T00:00:00'}
+    for size in sizes:
+        while thread_count * thread_messages < size:
+            tid = f't{thread_count}'
+            store.write_messages(sid(thread_count), tid, 0, [dict(message, id=f'{tid}-{i}', content=f"{message['content']}ref{tid}x{i}") for i in range(thread_messages)], thread(tid))
+            thread_count += 1
+        append, load, search_rare, search_common = [], [], [], []
+        for i in range(samples):
+            n = (i * 7919) % thread_count
+            tid = f't{n}'
+            started = time.perf_counter()
+            store.write_messages(sid(n), tid, thread_messages, [dict(message, id=f'{tid}-extra')], thread(tid))
+            append.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            store.load_messages(sid(n), tid)
+            load.append(time.perf_counter() - started)
+            # One matching message, and words in every message (the top 20 of all the user's messages)
+            started = time.perf_counter()
+            store.search(sid(n), f'ref{tid}x{i % thread_messages}')
+            search_rare.append(time.perf_counter() - started)
+            if i % 10 == 0:
+                started = time.perf_counter()
+                store.search(sid(n), 'project plan')
+                search_common.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        store.load_threads()
+        results.append({'messages': thread_count * thread_messages, 'threads': thread_count,
+                        'append_p50_ms': ms(percentile(append, 50)), 'append_p95_ms': ms(percentile(append, 95)),
+                        'load_thread_p50_ms': ms(percentile(load, 50)), 'load_all_threads_ms': ms(time.perf_counter() - started),
+                        'search_rare_p50_ms': ms(percentile(search_rare, 50)), 'search_common_p50_ms': ms(percentile(search_common, 50)),
+                        'db_mib': round(os.path.getsize(os.path.join(workdir, 'store-bench.db')) / 2**20, 1)})
+    return results
+def compare(summary, baseline, tolerance, min_delta_ms):
+    # Latency keys (lower is better) that got slower than the baseline by more than `tolerance` and `min_delta_ms`
+    regressions = []
+    for key, value in summary.items():
+        old = baseline.get(key)
+        if not key.endswith('_ms') or not isinstance(value, (int, float)) or not isinstance(old, (int, float)): continue
+        if old > 0 and value > old * (1 + tolerance) and value - old > min_delta_ms:
+            regressions.append(f"{key}: {old} -> {value} ms (+{(value / old - 1) * 100:.0f}%)")
+    return regressions
+def print_report(result):
+    load = result.get('load') or {}
+    print(f"\n== Load: {result['config']['sessions']} sessions x {result['config']['turns']} turns on {result['config']['server']} ==")
+    for key, value in load.items():
+        if key != 'by_history_length': print(f"  {key:38} {value}")
+    for row in load.get('by_history_length', []):
+        print(f"  turns {row['turns']:10} pre_upstream p50 {row['pre_upstream_p50_ms']} ms, post_stream p50 {row['post_stream_p50_ms']} ms")
+    if result.get('store'):
+        print("\n== Store ==")
+        for row in result['store']: print('  ' + ', '.join(f'{k}={v}' for k, v in row.items()))
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark KITT's own overhead against a mock Ollama server")
+    parser.add_argument('--server', choices=sorted(SERVERS), default='flask', help='How to run KITT (default: flask dev server)')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=32, help='gunicorn threads per worker')
+    parser.add_argument('--sessions', type=int, default=20, help='Concurrent simulated browser sessions')
+    parser.add_argument('--turns', type=int, default=10, help='Chat turns per session')
+    parser.add_argument('--message-repeat', type=int, default=4, help='Size of each user message, in copies of a filler sentence')
+    parser.add_argument('--max-generations', type=int, default=0, help='KITT_MAX_GENERATIONS_PER_MODEL (default: one per session, so nothing queues)')
+    parser.add_argument('--model', default='bench:latest')
+    parser.add_argument('--tokens-per-second', type=float, default=200.0)
+    parser.add_argument('--chunk-tokens', type=int, default=1)
+    parser.add_argument('--reply-tokens', type=int, default=64)
+    parser.add_argument('--think-tokens', type=int, default=0)
+    parser.add_argument('--first-token-delay', type=float, default=0.05)
+    parser.add_argument('--store-sizes', default='1000,10000,50000', help='Message counts for the store benchmark, empty to skip')
+    parser.add_argument('--skip-load', action='store_true', help='Only run the store benchmark')
+    parser.add_argument('--log-level', default='WARNING', help='KITT_LOG_LEVEL for the server')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Results file from an earlier run; exit with status 1 if latencies regressed')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown against the baseline (default: 0.25)')
+    parser.add_argument('--min-delta-ms', type=float, default=2.0, help='Ignore slowdowns smaller than this many milliseconds (default: 2)')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch directory (server.log, databases)')
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix='kitt-bench-')
+    result = {'config': vars(args)}
+    mock = MockOllama(models=[args.model], tokens_per_second=args.tokens_per_second, chunk_tokens=args.chunk_tokens,
+                      reply_tokens=args.reply_tokens, think_tokens=args.think_tokens, first_token_delay=args.first_token_delay).start()
+    try:
+        if not args.skip_load:
+            process, port = start_server(args, mock.url, workdir)
+            try:
+                turns, reads, wall, rss, scraped = run_load(args, mock, port, process.pid)
+                result['load'] = summarize_load(args, mock, turns, reads, wall, rss, scraped)
+            finally:
+                process.terminate()
+                try: process.wait(10)
+                except subprocess.TimeoutExpired: process.kill()
+        sizes = [int(s) for s in args.store_sizes.split(',') if s.strip()]
+        if sizes: result['store'] = bench_store(sizes, workdir)
+    finally:
+        mock.stop()
+        if args.keep: print(f"Scratch directory: {workdir}")
+        else: shutil.rmtree(workdir, ignore_errors=True)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+        flat = dict(result.get('load') or {})
+        for row in result.get('store') or []: flat.update({f"store_{row['messages']}_{k}": v for k, v in row.items() if k.endswith('_ms')})
+        old = dict(baseline.get('load') or {})
+        for row in baseline.get('store') or []: old.update({f"store_{row['messages']}_{k}": v for k, v in row.items() if k.endswith('_ms')})
+        regressions = compare(flat, old, args.tolerance, args.min_delta_ms)
+        print("\n== Compared with baseline ==")
+        for line in regressions or ['No regressions beyond tolerance']: print(f"  {line}")
+        if regressions: sys.exit(1)
+if __name__ == '__main__':
+    main()
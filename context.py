@@ -0,0 +1,67 @@
+import os
+import math
+# Rough token accounting: Ollama does not expose a tokenizer, so estimate from character counts.
+CHARS_PER_TOKEN = float(os.environ.get('KITT_CHARS_PER_TOKEN', '4'))
+MESSAGE_OVERHEAD_TOKENS = 4
+# 'trim' keeps the system prompt and latest message, trims files and drops the oldest history to fit; 'off' sends everything.
+CONTEXT_POLICY = os.environ.get('KITT_CONTEXT_POLICY', 'trim')
+RESPONSE_RESERVE_TOKENS = int(os.environ.get('KITT_RESPONSE_RESERVE_TOKENS', '1024'))
+FILE_BUDGET_SHARE = float(os.environ.get('KITT_FILE_BUDGET_SHARE', '0.6'))
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+def message_tokens(content):
+    return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+def truncate_file_block(block, max_chars):
+    if len(block) <= max_chars: return block
+    end_index = block.rfind('\n--- End File')
+    end_line = block[end_index:] if end_index != -1 else ''
+    header_end = block.find('\n') + 1 if block.startswith('--- File:') else 0
+    head = block[:max(header_end, max_chars - len(end_line) - 80)].rstrip('\n')
+    dropped = len(block) - len(head) - len(end_line)
+    return f"{head}\n[... {dropped} characters truncated to fit the context window ...]{end_line}"
+def share_budget(sizes, budget):
+    # Splits `budget` across items so small items keep everything and large ones share what is left.
+    allowance = {}
+    remaining = budget
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    for position, i in enumerate(order):
+        allowance[i] = min(sizes[i], remaining // (len(order) - position))
+        remaining -= allowance[i]
+    return [allowance[i] for i in range(len(sizes))]
+def fit_context(messages, file_blocks, system_prompt, context_window, file_context_intro=''):
+    # `file_blocks` is a list of (filename, block). Returns the history messages and file blocks to send, plus a report,
+    # for a request that must fit `context_window` tokens.
+    report = {
+        'context_window': context_window, 'prompt_tokens': 0, 'dropped_messages': 0, 'dropped_tokens': 0,
+        'truncated_files': [],
+    }
+    file_tokens = [estimate_tokens(block) for _, block in file_blocks]
+    history_tokens = [message_tokens(msg['content']) for msg in messages]
+    total = sum(file_tokens) + sum(history_tokens) + message_tokens(system_prompt) + estimate_tokens(file_context_intro)
+    if CONTEXT_POLICY == 'off' or not context_window or not messages:
+        report['prompt_tokens'] = total
+        return messages, [block for _, block in file_blocks], report
+    budget = max(0, context_window - min(RESPONSE_RESERVE_TOKENS, context_window // 4))
+    remaining = budget - message_tokens(system_prompt) - estimate_tokens(file_context_intro) - history_tokens[-1]
+    remaining = max(0, remaining)
+    older_tokens = sum(history_tokens[:-1])
+    # Files may use their share of what is left, plus whatever the history does not need
+    file_budget = min(sum(file_tokens), max(int(remaining * FILE_BUDGET_SHARE), remaining - older_tokens))
+    kept_blocks = []
+    for (filename, block), tokens, allowed in zip(file_blocks, file_tokens, share_budget(file_tokens, file_budget)):
+        if allowed < tokens:
+            block = truncate_file_block(block, int(allowed * CHARS_PER_TOKEN))
+            dropped = max(0, tokens - estimate_tokens(block))
+            report['truncated_files'].append({'file': filename, 'dropped_tokens': dropped})
+            report['dropped_tokens'] += dropped
+        kept_blocks.append(block)
+    remaining -= sum(estimate_tokens(block) for block in kept_blocks)
+    # Keep the most recent turns that still fit, always including the latest message
+    first_kept = len(messages) - 1
+    while first_kept > 0 and history_tokens[first_kept - 1] <= remaining:
+        remaining -= history_tokens[first_kept - 1]
+        first_kept -= 1
+    report['dropped_messages'] = first_kept
+    report['dropped_tokens'] += sum(history_tokens[:first_kept])
+    report['prompt_tokens'] = total - report['dropped_tokens']
+    return messages[first_kept:], kept_blocks, report
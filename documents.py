@@ -0,0 +1,267 @@
+import os
+import re
+import json
+import math
+import hashlib
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime
+from logs import get_logger
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+log = get_logger('documents')
+BINARY_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+CHUNK_CHARS = int(os.environ.get('KITT_CHUNK_CHARS', '1500'))
+MAX_UPLOAD_BYTES = int(float(os.environ.get('KITT_MAX_UPLOAD_MB', '50')) * 2**20)
+COPY_CHUNK_BYTES = 1 << 20
+# Memory for rendered file blocks and chunk indexes, per process; evicted entries are read back from .extracted/
+DOCUMENT_CACHE_BYTES = int(float(os.environ.get('KITT_DOCUMENT_CACHE_MB', '64')) * 2**20)
+# Rough in-memory cost of one entry of a chunk's term-count dict
+TERM_BYTES = 100
+STOPWORDS = {'the', 'and', 'for', 'are', 'but', 'not', 'you', 'all', 'any', 'can', 'had', 'her', 'was', 'one', 'our', 'out', 'has',
+             'his', 'how', 'its', 'who', 'did', 'this', 'that', 'with', 'from', 'they', 'what', 'when', 'which', 'will', 'would',
+             'there', 'their', 'been', 'have', 'into', 'than', 'then', 'them', 'these', 'some', 'could', 'about', 'does', 'please'}
+BM25_K1 = 1.2
+BM25_B = 0.75
+def normalize_text(text):
+    text = text.replace('\r\n', '\n').replace('\r', '\n').replace('\x00', '')
+    text = '\n'.join(line.rstrip() for line in text.split('\n'))
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+def looks_binary(data):
+    return b'\x00' in data[:8192]
+PDF_UNAVAILABLE = "PDF text extraction unavailable, install pypdf"
+def extract_pdf(path):
+    if PdfReader is None: return None, PDF_UNAVAILABLE
+    try:
+        reader = PdfReader(path)
+        return '\n\n'.join(page.extract_text() or '' for page in reader.pages), None
+    except Exception as e:
+        return None, f"PDF text extraction failed: {e}"
+def extract_text(path, filename, data):
+    # Returns (kind, text, note); text is None for files that should not be pasted into a prompt.
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if extension == 'pdf':
+        text, note = extract_pdf(path)
+        return 'pdf', text, note
+    if extension in BINARY_EXTENSIONS or looks_binary(data):
+        return 'binary', None, f"binary file ({extension or 'unknown type'}), not included"
+    return 'text', data.decode('utf-8', errors='replace'), None
+def tokenize(text):
+    return [t for t in re.findall(r'[a-z0-9_]+', text.lower()) if len(t) > 1 and t not in STOPWORDS]
+def chunk_text(text, max_chars=CHUNK_CHARS):
+    # Splits on line boundaries into chunks of about max_chars, remembering 1-based line ranges.
+    chunks, lines, size, start_line = [], [], 0, 1
+    for number, line in enumerate(text.split('\n'), 1):
+        while len(line) > max_chars:
+            if lines: chunks.append({'text': '\n'.join(lines), 'start_line': start_line, 'end_line': number - 1}); lines, size = [], 0
+            chunks.append({'text': line[:max_chars], 'start_line': number, 'end_line': number})
+            line = line[max_chars:]; start_line = number
+        if lines and size + len(line) + 1 > max_chars:
+            chunks.append({'text': '\n'.join(lines), 'start_line': start_line, 'end_line': number - 1})
+            lines, size = [], 0
+        if not lines: start_line = number
+        lines.append(line); size += len(line) + 1
+    if lines: chunks.append({'text': '\n'.join(lines), 'start_line': start_line, 'end_line': start_line + len(lines) - 1})
+    for chunk in chunks:
+        terms = tokenize(chunk['text'])
+        chunk['length'] = len(terms)
+        chunk['terms'] = dict(Counter(terms))
+    return chunks
+def rank_chunks(chunks, query):
+    # BM25 over the given (filename, chunk) pairs; returns them best first, skipping chunks with no query terms.
+    query_terms = set(tokenize(query))
+    if not chunks or not query_terms: return []
+    average_length = sum(chunk['length'] for _, chunk in chunks) / len(chunks) or 1
+    document_frequency = Counter(term for _, chunk in chunks for term in query_terms if term in chunk['terms'])
+    scored = []
+    for filename, chunk in chunks:
+        score = 0.0
+        for term in query_terms:
+            frequency = chunk['terms'].get(term)
+            if not frequency: continue
+            idf = math.log(1 + (len(chunks) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            score += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * (1 - BM25_B + BM25_B * chunk['length'] / average_length))
+        if score > 0: scored.append((score, filename, chunk))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return scored
+class UploadTooLarge(Exception):
+    pass
+class BlobStore:
+    # Uploaded bytes stored once per content, at <root>/<sha256[:2]>/<sha256>.
+    def __init__(self, root):
+        self.root = root
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+    def exists(self, sha256):
+        return os.path.exists(self.path(sha256))
+    def save_stream(self, stream, max_bytes=MAX_UPLOAD_BYTES):
+        # Copies `stream` to disk in chunks while hashing it; returns (sha256, size). Raises UploadTooLarge past max_bytes.
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.upload-')
+        digest, size = hashlib.sha256(), 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(COPY_CHUNK_BYTES)
+                    if not chunk: break
+                    size += len(chunk)
+                    if size > max_bytes: raise UploadTooLarge(f"File is larger than {max_bytes / 2**20:g} MB")
+                    digest.update(chunk); f.write(chunk)
+            sha256 = digest.hexdigest()
+            os.makedirs(os.path.dirname(self.path(sha256)), exist_ok=True)
+            # Identical content lands on the same path; replacing it keeps the blob present even if a delete raced with us
+            os.replace(tmp_path, self.path(sha256))
+            return sha256, size
+        except BaseException:
+            try: os.remove(tmp_path)
+            except FileNotFoundError: pass
+            raise
+    def remove(self, sha256):
+        try: os.remove(self.path(sha256))
+        except FileNotFoundError: pass
+class SizedLRU:
+    # LRU bounded by the total estimated size of its values rather than their number, since one upload can be
+    # megabytes of text. A value over the whole budget is not kept. Not thread-safe; callers hold their own lock.
+    def __init__(self, max_bytes, sizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None: return None
+        self._entries.move_to_end(key)
+        return entry[0]
+    def put(self, key, value):
+        self.pop(key)
+        size = self.sizeof(value)
+        if size > self.max_bytes: return
+        self._entries[key] = (value, size); self.size += size
+        while self.size > self.max_bytes: self.size -= self._entries.popitem(last=False)[1][1]
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None: self.size -= entry[1]
+    def keys(self):
+        return list(self._entries)
+    def __len__(self):
+        return len(self._entries)
+def cached_size(value):
+    # A rendered block (str) or a chunk list
+    if isinstance(value, str): return len(value)
+    return sum(len(chunk['text']) + TERM_BYTES * len(chunk['terms']) for chunk in value)
+class DocumentStore:
+    # Extracts each uploaded blob once and keeps its text, chunks and rendered prompt block. Blobs are named by
+    # their content hash and never change; only PDFs stored while pypdf was missing are extracted again once it is installed.
+    def __init__(self, upload_folder):
+        self.upload_folder = upload_folder
+        self.blobs = BlobStore(os.path.join(upload_folder, 'blobs'))
+        self.extracted_folder = os.path.join(upload_folder, '.extracted')
+        # ('rendered', sha256, filename) -> prompt block and ('chunks', sha256) -> lexical index, sharing one budget
+        self._cache = SizedLRU(DOCUMENT_CACHE_BYTES, cached_size)
+        self._lock = threading.Lock()
+    def _paths(self, sha256):
+        base = os.path.join(self.extracted_folder, sha256)
+        return base + '.json', base + '.txt', base + '.chunks.json'
+    def _write_atomic(self, path, content):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f: f.write(content)
+        os.replace(tmp_path, path)
+    def ingest(self, sha256, filename):
+        # `filename` only decides how the content is read (by extension); the results are shared by every name for this blob
+        path = self.blobs.path(sha256)
+        with open(path, 'rb') as f: data = f.read()
+        kind, text, note = extract_text(path, filename, data)
+        text = normalize_text(text) if text is not None else None
+        meta = {'sha256': sha256, 'kind': kind, 'size': len(data), 'chars': len(text) if text is not None else 0, 'note': note}
+        os.makedirs(self.extracted_folder, exist_ok=True)
+        meta_path, text_path, chunks_path = self._paths(sha256)
+        chunks = chunk_text(text) if text and not note else []
+        meta['chunks'] = len(chunks)
+        self._write_atomic(text_path, text or '')
+        self._write_atomic(chunks_path, json.dumps(chunks))
+        self._write_atomic(meta_path, json.dumps(meta))
+        log.info(f"Ingested {filename} ({sha256[:12]}): {kind}, {meta['size']} bytes, {meta['chars']} chars of text" + (f" ({note})" if note else ""))
+        return meta
+    def _stored_meta(self, sha256):
+        # The saved extraction metadata, or None if there is none or it should be redone
+        try:
+            with open(self._paths(sha256)[0], 'r') as f: meta = json.load(f)
+        except (OSError, ValueError): return None
+        if meta.get('kind') == 'pdf' and meta.get('note') == PDF_UNAVAILABLE and PdfReader is not None: return None
+        return meta
+    def ensure(self, sha256, filename):
+        # The blob's extraction metadata, extracting it only if no earlier upload of the same content did
+        return self._stored_meta(sha256) or self.ingest(sha256, filename)
+    def load(self, sha256, filename):
+        # Returns (meta, text); text is None for content that is not pasted into prompts.
+        meta = self.ensure(sha256, filename)
+        text_path = self._paths(sha256)[1]
+        try:
+            with open(text_path, 'r', encoding='utf-8') as f: text = f.read()
+        except OSError:
+            meta = self.ingest(sha256, filename)
+            with open(text_path, 'r', encoding='utf-8') as f: text = f.read()
+        return meta, (text if not meta.get('note') else None)
+    def render(self, filename, sha256):
+        # The "--- File: ... ---" block for a prompt, served from memory after the first use.
+        with self._lock: cached = self._cache.get(('rendered', sha256, filename))
+        if cached: return cached
+        meta, text = self.load(sha256, filename)
+        body = text if text is not None else f"[{meta.get('note') or 'no text content'}]"
+        block = f"--- File: {filename} ---\n{body}\n--- End File: {filename} ---"
+        with self._lock: self._cache.put(('rendered', sha256, filename), block)
+        return block
+    def chunks(self, sha256, filename):
+        # The blob's lexical index (chunks with term counts), kept in memory after the first use.
+        with self._lock: cached = self._cache.get(('chunks', sha256))
+        if cached is not None: return cached
+        self.ensure(sha256, filename)
+        try:
+            with open(self._paths(sha256)[2], 'r', encoding='utf-8') as f: chunks = json.load(f)
+        except (OSError, ValueError):
+            self.ingest(sha256, filename)
+            with open(self._paths(sha256)[2], 'r', encoding='utf-8') as f: chunks = json.load(f)
+        with self._lock: self._cache.put(('chunks', sha256), chunks)
+        return chunks
+    def render_relevant(self, files, query, top_k=8, max_chars=12000):
+        # `files` is [(filename, sha256)]. Returns [(filename, block)] with only the chunks that best match `query`;
+        # files that fit in one chunk are kept whole.
+        whole, candidates = {}, []
+        for filename, sha256 in files:
+            chunks = self.chunks(sha256, filename)
+            if len(chunks) <= 1: whole[filename] = self.render(filename, sha256)
+            else: candidates.extend((filename, chunk) for chunk in chunks)
+        selected, used = {}, sum(len(block) for block in whole.values())
+        for _, filename, chunk in rank_chunks(candidates, query)[:top_k]:
+            if used + len(chunk['text']) > max_chars: continue
+            selected.setdefault(filename, []).append(chunk); used += len(chunk['text'])
+        blocks = []
+        for filename, _ in files:
+            if filename in whole: blocks.append((filename, whole[filename])); continue
+            excerpts = sorted(selected.get(filename, []), key=lambda chunk: chunk['start_line'])
+            body = '\n'.join(f"[lines {c['start_line']}-{c['end_line']}]\n{c['text']}" for c in excerpts) or "[no sections matched the question]"
+            blocks.append((filename, f"--- File: {filename} (most relevant excerpts) ---\n{body}\n--- End File: {filename} ---"))
+        return blocks
+    def import_legacy(self):
+        # Files uploaded before content addressing sit directly in the upload folder. Copies them into the blob
+        # store (the originals are left in place) and returns their file entries.
+        try: names = sorted(n for n in os.listdir(self.upload_folder) if not n.startswith('.') and os.path.isfile(os.path.join(self.upload_folder, n)))
+        except FileNotFoundError: return []
+        entries = []
+        for name in names:
+            path = os.path.join(self.upload_folder, name)
+            with open(path, 'rb') as f: sha256, size = self.blobs.save_stream(f, max_bytes=math.inf)
+            entries.append({'name': name, 'sha256': sha256, 'size': size, 'uploaded_at': datetime.fromtimestamp(os.path.getmtime(path)).isoformat()})
+        return entries
+    def remove(self, sha256):
+        # Deletes the blob and its extracted data; call once no file name refers to it any more
+        with self._lock:
+            for key in self._cache.keys():
+                if key[1] == sha256: self._cache.pop(key)
+        self.blobs.remove(sha256)
+        for path in self._paths(sha256):
+            try: os.remove(path)
+            except FileNotFoundError: pass
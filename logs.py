@@ -0,0 +1,54 @@
+import os
+import json
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+# Log records are handed to a background thread, so request and streaming threads never block on console writes.
+LOG_LEVEL = os.environ.get('KITT_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('KITT_LOG_FORMAT', 'text')
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        return f"{line} {' '.join(f'{k}={v}' for k, v in fields.items())}" if fields else line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info: entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+class _InProcessQueueHandler(QueueHandler):
+    # The queue never leaves the process, so keep exc_info for the formatter instead of flattening it into the message.
+    # The writer thread is started per process: a thread started before fork() (gunicorn --preload) does not exist in workers.
+    def __init__(self, console):
+        super().__init__(queue.SimpleQueue())
+        self.console = console
+        self._listener_pid = None
+    def _start_listener(self):
+        self.queue = queue.SimpleQueue()
+        listener = QueueListener(self.queue, self.console, respect_handler_level=False)
+        listener.start()
+        atexit.register(listener.stop)
+        self._listener_pid = os.getpid()
+    def prepare(self, record):
+        record.msg, record.args = record.getMessage(), None
+        return record
+    def emit(self, record):
+        if self._listener_pid != os.getpid(): self._start_listener()
+        super().emit(record)
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    root = logging.getLogger('kitt')
+    root.setLevel(getattr(logging, level, logging.INFO))
+    if any(isinstance(h, _InProcessQueueHandler) for h in root.handlers): return root
+    console = logging.StreamHandler()
+    console.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    root.addHandler(_InProcessQueueHandler(console))
+    root.propagate = False
+    return root
+def get_logger(name):
+    # Module loggers live under "kitt"; pass key/value context as extra={'fields': {...}}
+    setup_logging()
+    return logging.getLogger(f'kitt.{name}')
@@ -0,0 +1,88 @@
+import math
+import threading
+# Minimal Prometheus text-format metrics, kept in memory per process and served on /metrics.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250)
+_registry = []
+_lock = threading.Lock()
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs: return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+def _format_value(value):
+    if value == math.inf: return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+class _Metric:
+    kind = None
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        with _lock: _registry.append(self)
+    def labels(self, *values):
+        return _Child(self, tuple(str(v) for v in values))
+    def _samples(self):
+        raise NotImplementedError
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with _lock: lines.extend(self._samples())
+        return '\n'.join(lines)
+class _Child:
+    # A metric bound to one set of label values
+    def __init__(self, metric, values):
+        self.metric, self.values = metric, values
+    def inc(self, amount=1): self.metric.inc(amount, self.values)
+    def dec(self, amount=1): self.metric.inc(-amount, self.values)
+    def set(self, value): self.metric.set(value, self.values)
+    def observe(self, value): self.metric.observe(value, self.values)
+class Counter(_Metric):
+    kind = 'counter'
+    def inc(self, amount=1, values=()):
+        with _lock: self._values[values] = self._values.get(values, 0) + amount
+    def _samples(self):
+        return [f'{self.name}{_format_labels(self.labelnames, v)} {_format_value(n)}' for v, n in self._values.items()]
+class Gauge(Counter):
+    kind = 'gauge'
+    def set(self, value, values=()):
+        with _lock: self._values[values] = value
+class Histogram(_Metric):
+    kind = 'histogram'
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+    def observe(self, value, values=()):
+        with _lock:
+            counts, total = self._values.get(values, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: counts[i] += 1
+            self._values[values] = (counts, total + value)
+    def _samples(self):
+        lines = []
+        for values, (counts, total) in self._values.items():
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, values, [("le", _format_value(bound))])} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, values)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, values)} {counts[-1]}')
+        return lines
+def render():
+    with _lock: metrics = list(_registry)
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+request_duration = Histogram('kitt_http_request_duration_seconds', 'Time to produce the response headers, per route.', ('method', 'route', 'status'))
+first_chunk_seconds = Histogram('kitt_ollama_first_chunk_seconds', 'Time from sending a chat to Ollama until its first streamed token.', ('model',))
+stream_seconds = Histogram('kitt_ollama_stream_duration_seconds', 'Total generation time reported by Ollama (total_duration).', ('model',))
+load_seconds = Histogram('kitt_ollama_load_seconds', 'Model load time reported by Ollama (load_duration); high values mean the model was not kept loaded.', ('model',))
+prompt_eval_share = Histogram('kitt_ollama_prompt_eval_share', 'Prompt tokens Ollama evaluated, as a share of the estimated prompt; low values mean its cache was reused.', ('model',), (0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 1, 1.5, 2))
+prompt_eval_seconds = Histogram('kitt_ollama_prompt_eval_seconds', 'Prompt processing time reported by Ollama (prompt_eval_duration).', ('model',))
+eval_tokens_per_second = Histogram('kitt_ollama_eval_tokens_per_second', 'Generation speed reported by Ollama (eval_count / eval_duration).', ('model',), RATE_BUCKETS)
+eval_tokens = Counter('kitt_ollama_eval_tokens_total', 'Tokens generated by Ollama.', ('model',))
+prompt_eval_tokens = Counter('kitt_ollama_prompt_eval_tokens_total', 'Prompt tokens evaluated by Ollama.', ('model',))
+stream_errors = Counter('kitt_ollama_stream_errors_total', 'Chat streams that ended with an error.', ('model',))
+queue_wait_seconds = Histogram('kitt_generation_queue_wait_seconds', 'Time chats waited for a generation slot.', ('model',))
+active_streams = Gauge('kitt_active_streams', 'Chat streams currently generating.', ('model',))
+prompt_tokens = Histogram('kitt_prompt_tokens', 'Estimated size of the assembled prompt sent to Ollama.', ('model',), TOKEN_BUCKETS)
+store_write_seconds = Histogram('kitt_store_write_seconds', 'Time spent writing to the conversation store.', ('operation',))
+store_write_bytes = Counter('kitt_store_write_bytes_total', 'Message JSON written to the conversation store.', ('operation',))
@@ -0,0 +1,299 @@
+import os
+import json
+import math
+import time
+import hashlib
+import asyncio
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from logs import get_logger
+log = get_logger('ollama')
+# (connect, read) timeouts in seconds per Ollama endpoint; the read timeout is the longest gap between bytes.
+TIMEOUTS = {
+    'tags': (5, float(os.environ.get('KITT_TAGS_TIMEOUT', '10'))),
+    'show': (5, float(os.environ.get('KITT_SHOW_TIMEOUT', '10'))),
+    'chat': (5, float(os.environ.get('KITT_CHAT_TIMEOUT', '600'))),
+    'generate': (5, float(os.environ.get('KITT_GENERATE_TIMEOUT', '120'))),
+    'ps': (5, 10),
+}
+POOL_SIZE = int(os.environ.get('KITT_OLLAMA_POOL_SIZE', '32'))
+http = requests.Session()
+http.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE))
+http.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE))
+def base_url():
+    return os.environ.get('OLLAMA_API_URL', 'http://localhost:11434')
+def get(endpoint, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUTS[endpoint])
+    return http.get(f'{base_url()}/api/{endpoint}', **kwargs)
+def post(endpoint, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUTS[endpoint])
+    return http.post(f'{base_url()}/api/{endpoint}', **kwargs)
+# Ollama's context window when a model does not set num_ctx itself
+DEFAULT_NUM_CTX = int(os.environ.get('KITT_DEFAULT_NUM_CTX', '4096'))
+MODELS_TTL = float(os.environ.get('KITT_MODELS_TTL', '60'))
+def parse_context_length(show):
+    # The effective window is the Modelfile's num_ctx if set, else Ollama's default capped by what the model supports.
+    for line in (show.get('parameters') or '').splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == 'num_ctx' and parts[1].isdigit(): return int(parts[1])
+    trained = next((v for k, v in (show.get('model_info') or {}).items() if k.endswith('.context_length') and isinstance(v, int)), None)
+    return min(trained, DEFAULT_NUM_CTX) if trained else DEFAULT_NUM_CTX
+def parse_details(show):
+    details = show.get('details') or {}
+    return {
+        'context_length': parse_context_length(show), 'parameter_size': details.get('parameter_size'),
+        'family': details.get('family'), 'quantization_level': details.get('quantization_level'),
+        'capabilities': show.get('capabilities') or [],
+    }
+class ModelCatalog:
+    # The /api/tags list and per-model /api/show details, served from memory. Once the list is older than `ttl`
+    # it is still served while a background thread fetches a fresh copy; details are kept until a model's digest changes.
+    def __init__(self, ttl=MODELS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._models = None
+        self._etag = None
+        self._last_modified = None
+        self._fetched_at = 0
+        self._refreshing = False
+        self._details = {}
+    def refresh(self):
+        response = get('tags')
+        response.raise_for_status()
+        models = sorted(response.json().get('models', []), key=lambda x: x.get('name', ''))
+        etag = hashlib.sha1(json.dumps(models, sort_keys=True).encode()).hexdigest()[:20]
+        digests = {m.get('name'): m.get('digest') for m in models}
+        with self._lock:
+            if etag != self._etag:
+                self._models, self._etag, self._last_modified = models, etag, time.time()
+                self._details = {name: d for name, d in self._details.items() if name in digests and d[0] == digests[name]}
+            self._fetched_at = time.monotonic()
+            return self._models, self._etag, self._last_modified
+    def models(self):
+        # Returns (models, etag, last_modified); only blocks on Ollama when nothing has been fetched yet.
+        with self._lock:
+            cached = (self._models, self._etag, self._last_modified)
+            stale = time.monotonic() - self._fetched_at > self.ttl
+        if cached[0] is None:
+            cached = self.refresh()
+            self._refresh_in_background(refresh_list=False)
+        elif stale: self._refresh_in_background()
+        return cached
+    def _refresh_in_background(self, refresh_list=True):
+        with self._lock:
+            if self._refreshing: return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, args=(refresh_list,), name='model-catalog', daemon=True).start()
+    def _background_refresh(self, refresh_list):
+        try:
+            models = self.refresh()[0] if refresh_list else self._models
+            # Warm the details of every listed model so chats don't wait on /api/show
+            for model in models or []:
+                with self._lock: known = model.get('name') in self._details
+                if not known: self.details(model.get('name'))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log.warning(f"Background refresh of the model list failed, serving the cached copy: {e}")
+            with self._lock: self._fetched_at = time.monotonic()  # retry after another ttl, not on every request
+        finally:
+            with self._lock: self._refreshing = False
+    def details(self, model):
+        with self._lock:
+            cached = self._details.get(model)
+            digest = next((m.get('digest') for m in self._models or [] if m.get('name') == model), None)
+        if cached: return cached[1]
+        try:
+            response = post('show', json={'model': model})
+            response.raise_for_status()
+            details = parse_details(response.json())
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log.warning(f"Could not read details for {model}, assuming a {DEFAULT_NUM_CTX} token context: {e}")
+            return {'context_length': DEFAULT_NUM_CTX}
+        with self._lock: self._details[model] = (digest, details)
+        return details
+    def cached_details(self):
+        with self._lock: return {name: d[1] for name, d in self._details.items()}
+    def context_length(self, model):
+        return self.details(model)['context_length']
+# How long Ollama keeps a model loaded after a request ("30m", "1h", seconds, or -1 for ever); empty uses Ollama's default.
+KEEP_ALIVE = os.environ.get('KITT_KEEP_ALIVE', '30m')
+# Per-model overrides, e.g. "llama3:70b=5m,qwen3=2h" (a name without a tag matches every tag)
+MODEL_KEEP_ALIVE = dict(item.split('=', 1) for item in os.environ.get('KITT_MODEL_KEEP_ALIVE', '').split(',') if '=' in item)
+OLLAMA_DEFAULT_KEEP_ALIVE = 300
+def parse_duration(value):
+    # Seconds for an Ollama keep_alive value; None if it can't be read, infinity for a negative value.
+    value = str(value).strip()
+    try: seconds = float(value)
+    except ValueError:
+        units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+        unit = next((u for u in ('ms', 's', 'm', 'h') if value.endswith(u)), None)
+        try: seconds = float(value[:-len(unit)]) * units[unit] if unit else None
+        except ValueError: seconds = None
+    if seconds is None: return None
+    return math.inf if seconds < 0 else seconds
+class ModelSessions:
+    # Keeps models loaded between turns: every request carries the model's keep_alive, and a model can be loaded
+    # ahead of its first chat (e.g. when picked in the UI) so that turn doesn't pay for the load.
+    def __init__(self, keep_alive=KEEP_ALIVE, per_model=MODEL_KEEP_ALIVE):
+        self.default_keep_alive = keep_alive
+        self.per_model = per_model
+        self._last_used = {}
+        self._warming = set()
+        self._lock = threading.Lock()
+    def keep_alive(self, model):
+        value = self.per_model.get(model) or self.per_model.get(model.split(':', 1)[0]) or self.default_keep_alive
+        if not value: return None
+        return int(value) if value.lstrip('-').isdigit() else value
+    def touch(self, model):
+        with self._lock: self._last_used[model] = time.monotonic()
+    def is_warm(self, model):
+        # Whether this process used the model recently enough that Ollama should still have it loaded
+        keep_alive = self.keep_alive(model)
+        seconds = parse_duration(keep_alive) if keep_alive is not None else OLLAMA_DEFAULT_KEEP_ALIVE
+        with self._lock: last_used = self._last_used.get(model)
+        return last_used is not None and time.monotonic() - last_used < (seconds or 0)
+    def warm(self, model):
+        # Starts loading the model in the background; returns False if it is already loaded or loading.
+        if self.is_warm(model): return False
+        with self._lock:
+            if model in self._warming: return False
+            self._warming.add(model)
+        threading.Thread(target=self._load, args=(model,), name='model-warm', daemon=True).start()
+        return True
+    def loaded(self):
+        # Names of the models Ollama has in memory right now
+        response = get('ps')
+        response.raise_for_status()
+        return {m.get('name') for m in response.json().get('models', [])}
+    def _load(self, model):
+        try:
+            try: already_loaded = model in self.loaded()
+            except (requests.exceptions.RequestException, ValueError): already_loaded = False  # older Ollama without /api/ps
+            # A generate request without a prompt loads the model (or extends its keep_alive) and returns at once
+            started = time.monotonic()
+            payload = {'model': model, 'stream': False}
+            if self.keep_alive(model) is not None: payload['keep_alive'] = self.keep_alive(model)
+            response = post('generate', json=payload)
+            response.raise_for_status()
+            self.touch(model)
+            log.info(f"Model {model} {'was already loaded' if already_loaded else 'loaded'} in {time.monotonic() - started:.2f}s",
+                     extra={'fields': {'model': model, 'load_duration': response.json().get('load_duration')}})
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log.warning(f"Could not pre-load {model}: {e}")
+        finally:
+            with self._lock: self._warming.discard(model)
+class QueueFull(Exception):
+    pass
+class GenerationLimiter:
+    # Caps in-flight generations per model; extra requests wait in FIFO order.
+    def __init__(self, max_per_model, max_queue):
+        self.max_per_model = max(1, max_per_model)
+        self.max_queue = max_queue
+        self._cond = threading.Condition()
+        self._active = {}
+        self._waiting = {}
+    def try_acquire(self, model):
+        with self._cond:
+            if self._waiting.get(model) or self._active.get(model, 0) >= self.max_per_model: return False
+            self._active[model] = self._active.get(model, 0) + 1
+            return True
+    def wait(self, model, heartbeat=15):
+        # Generator: yields the 1-based queue position whenever it changes (and every `heartbeat` seconds),
+        # and finishes once a slot is held. Closing it early gives up the place in the queue.
+        ticket = object()
+        with self._cond:
+            waiting = self._waiting.setdefault(model, [])
+            if self.max_queue and len(waiting) >= self.max_queue: raise QueueFull(model)
+            waiting.append(ticket)
+        acquired = False
+        try:
+            reported, reported_at = None, 0
+            while True:
+                with self._cond:
+                    position = waiting.index(ticket) + 1
+                    if position == 1 and self._active.get(model, 0) < self.max_per_model:
+                        waiting.pop(0)
+                        self._active[model] = self._active.get(model, 0) + 1
+                        acquired = True
+                        self._cond.notify_all()
+                        return
+                    remaining = heartbeat - (time.monotonic() - reported_at)
+                    if position == reported and remaining > 0:
+                        self._cond.wait(timeout=remaining)
+                        continue
+                reported, reported_at = position, time.monotonic()
+                yield position
+        finally:
+            if not acquired:
+                with self._cond:
+                    if ticket in waiting: waiting.remove(ticket)
+                    self._cond.notify_all()
+    def release(self, model):
+        with self._cond:
+            self._active[model] = max(0, self._active.get(model, 0) - 1)
+            self._cond.notify_all()
+    def active(self, model=None):
+        with self._cond:
+            return self._active.get(model, 0) if model else sum(self._active.values())
+    def queued(self, model=None):
+        with self._cond:
+            return len(self._waiting.get(model, [])) if model else sum(len(w) for w in self._waiting.values())
+class AsyncGenerationLimiter:
+    # asyncio counterpart of GenerationLimiter for the ASGI server, where waiting must not hold a thread.
+    def __init__(self, max_per_model, max_queue):
+        self.max_per_model = max(1, max_per_model)
+        self.max_queue = max_queue
+        self._cond = None
+        self._active = {}
+        self._waiting = {}
+    def _condition(self):
+        if self._cond is None: self._cond = asyncio.Condition()
+        return self._cond
+    def try_acquire(self, model):
+        if self._waiting.get(model) or self._active.get(model, 0) >= self.max_per_model: return False
+        self._active[model] = self._active.get(model, 0) + 1
+        return True
+    async def wait(self, model, heartbeat=15):
+        cond = self._condition()
+        waiting = self._waiting.setdefault(model, [])
+        if self.max_queue and len(waiting) >= self.max_queue: raise QueueFull(model)
+        ticket = object()
+        waiting.append(ticket)
+        acquired = False
+        try:
+            reported, reported_at = None, 0
+            while True:
+                async with cond:
+                    position = waiting.index(ticket) + 1
+                    if position == 1 and self._active.get(model, 0) < self.max_per_model:
+                        waiting.pop(0)
+                        self._active[model] = self._active.get(model, 0) + 1
+                        acquired = True
+                        cond.notify_all()
+                        return
+                    remaining = heartbeat - (time.monotonic() - reported_at)
+                    if position == reported and remaining > 0:
+                        try: await asyncio.wait_for(cond.wait(), timeout=remaining)
+                        except asyncio.TimeoutError: pass
+                        continue
+                reported, reported_at = position, time.monotonic()
+                yield position
+        finally:
+            if not acquired:
+                if ticket in waiting: waiting.remove(ticket)
+                await self._notify()
+    async def release(self, model):
+        self._active[model] = max(0, self._active.get(model, 0) - 1)
+        await self._notify()
+    async def _notify(self):
+        cond = self._condition()
+        async with cond: cond.notify_all()
+    def active(self, model=None):
+        return self._active.get(model, 0) if model else sum(self._active.values())
+    def queued(self, model=None):
+        return len(self._waiting.get(model, [])) if model else sum(len(w) for w in self._waiting.values())
+generation_limiter = GenerationLimiter(
+    max_per_model=int(os.environ.get('KITT_MAX_GENERATIONS_PER_MODEL', '2')),
+    max_queue=int(os.environ.get('KITT_MAX_QUEUE_PER_MODEL', '32')))
+model_catalog = ModelCatalog()
+model_sessions = ModelSessions()
@@ -5,15 +5,23 @@ document.addEventListener('DOMContentLoaded', () => {
         isStreaming: false,
         uploadInProgress: false,
         saveTimeout: null,
+        searchTimeout: null,
+        searchSeq: 0,
         currentThreadId: null,
         renameThreadId: null,
         abortController: null,
         systemPrompt: localStorage.getItem('systemPrompt') || 'You are a helpful assistant.',
         fileContextIntro: localStorage.getItem('fileContextIntro') || DEFAULT_FILE_CONTEXT_INTRO,
         appendFileContext: JSON.parse(localStorage.getItem('appendFileContext') || 'false'), 
+        // null until the switch is used: requests then leave `retrieval` out and the server default (KITT_RETRIEVAL) applies
+        useRetrieval: JSON.parse(localStorage.getItem('useRetrieval') ?? 'null'),
         currentHistory: [],
         temporaryHistory: [],
+        threadsCursor: null,
+        historyOffset: 0,
     };
+    const THREADS_PAGE_SIZE = 100;
+    const HISTORY_PAGE_SIZE = 50;
     const elements = {
         modelDropdown: document.getElementById('model-dropdown'),
         messageInput: document.getElementById('message-input'),
@@ -32,8 +40,11 @@ document.addEventListener('DOMContentLoaded', () => {
         saveStatusDiv: document.getElementById('save-status'),
         fileContextIntroInput: document.getElementById('file-context-intro-input'),
         appendFileContextSwitch: document.getElementById('append-file-context-switch'),
+        retrievalSwitch: document.getElementById('retrieval-switch'),
         newThreadBtn: document.getElementById('new-thread-btn'),
         threadsContainer: document.getElementById('threads-container'),
+        threadSearchInput: document.getElementById('thread-search-input'),
+        searchResults: document.getElementById('search-results'),
         renameThreadModal: document.getElementById('rename-thread-modal'),
         threadNameInput: document.getElementById('thread-name-input'),
         cancelRenameBtn: document.getElementById('cancel-rename-btn'),
@@ -91,6 +102,13 @@ document.addEventListener('DOMContentLoaded', () => {
                 console.error("Failed to fetch models:", result.error);
                 ui.displayModels([]);
             }
+            if (elements.modelDropdown.value) this.warmModel(elements.modelDropdown.value);
+            return result;
+        },
+        async warmModel(model) {
+            // Asks the server to load the model now so the first message doesn't wait for it
+            const result = await this._fetchAPI('/api/models/warm', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ model }) });
+            if (!result.success) console.warn(`Failed to warm model ${model}:`, result.error);
             return result;
         },
         async fetchFiles() {
@@ -104,8 +122,9 @@ document.addEventListener('DOMContentLoaded', () => {
             return result;
         },
         async fetchThreads() {
-            const result = await this._fetchAPI('/api/threads');
+            const result = await this._fetchAPI(`/api/threads?limit=${THREADS_PAGE_SIZE}`);
             if (result.success && result.data) {
+                state.threadsCursor = result.data.next_cursor || null;
                 ui.displayThreads(result.data.threads || [], result.data.active_thread);
                 if (state.currentThreadId === null && result.data.active_thread) {
                     state.currentThreadId = result.data.active_thread;
@@ -117,6 +136,20 @@ document.addEventListener('DOMContentLoaded', () => {
             }
             return result;
         },
+        async searchConversations(query) {
+            return await this._fetchAPI(`/api/search?q=${encodeURIComponent(query)}&limit=30`);
+        },
+        async fetchMoreThreads() {
+            if (!state.threadsCursor) return { success: true, data: null };
+            const result = await this._fetchAPI(`/api/threads?limit=${THREADS_PAGE_SIZE}&cursor=${encodeURIComponent(state.threadsCursor)}`);
+            if (result.success && result.data) {
+                state.threadsCursor = result.data.next_cursor || null;
+                ui.appendThreads(result.data.threads || [], result.data.active_thread);
+            } else {
+                console.error("Failed to fetch more threads:", result.error);
+            }
+            return result;
+        },
         async fetchConversationHistory() {
             if (!state.currentThreadId) {
                 console.warn("Attempted to fetch history with no active thread ID.");
@@ -126,25 +159,55 @@ document.addEventListener('DOMContentLoaded', () => {
                 return { success: false, error: "No active thread ID" };
             }
             console.log(`Fetching history for thread: ${state.currentThreadId}`);
-            const result = await this._fetchAPI('/api/conversation/history');
+            const result = await this._fetchAPI(`/api/conversation/history?limit=${HISTORY_PAGE_SIZE}`);
             if (result.success && result.data) {
                  if (result.data.thread_id !== state.currentThreadId) {
                      console.warn(`History received for thread ${result.data.thread_id}, but expected ${state.currentThreadId}. State mismatch? Correcting state.`);
                      state.currentThreadId = result.data.thread_id;
                      await api.fetchThreads();
                  }
-                 state.currentHistory = result.data.history || [];
-                 state.temporaryHistory = JSON.parse(JSON.stringify(state.currentHistory));
+                 setHistoryPage(result.data);
                  console.log("Fetched and set history. Current:", state.currentHistory.length, "Temp:", state.temporaryHistory.length);
                  ui.renderMessages(state.temporaryHistory);
             } else {
                 console.error("Failed to fetch conversation history:", result.error);
-                state.currentHistory = [];
-                state.temporaryHistory = [];
+                setHistoryPage({});
                 ui.renderMessages(state.temporaryHistory);
             }
             return result;
         },
+        async fetchEarlierHistory() {
+            const firstMessage = state.currentHistory[0];
+            if (!state.historyOffset || !firstMessage) return { success: true, data: null };
+            const result = await this._fetchAPI(`/api/conversation/history?limit=${HISTORY_PAGE_SIZE}&before=${encodeURIComponent(firstMessage.id)}`);
+            if (result.success && result.data) {
+                const earlier = result.data.history || [];
+                state.currentHistory = [...earlier, ...state.currentHistory];
+                state.temporaryHistory = [...JSON.parse(JSON.stringify(earlier)), ...state.temporaryHistory];
+                state.historyOffset = result.data.offset || 0;
+                // Keep the messages the user was looking at in place
+                const previousHeight = elements.chatMessages.scrollHeight;
+                const previousTop = elements.chatMessages.scrollTop;
+                ui.renderMessages(state.temporaryHistory);
+                elements.chatMessages.scrollTop = previousTop + elements.chatMessages.scrollHeight - previousHeight;
+            } else {
+                console.error("Failed to fetch earlier messages:", result.error);
+            }
+            return result;
+        },
+        async syncHistorySince(sinceId) {
+            // After a reply: fetch only the messages after the last one the server already had
+            if (!sinceId) return await this.fetchConversationHistory();
+            const result = await this._fetchAPI(`/api/conversation/history?limit=${HISTORY_PAGE_SIZE}&since=${encodeURIComponent(sinceId)}`);
+            const knownIndex = state.temporaryHistory.findIndex(msg => msg.id === sinceId);
+            if (!result.success || !result.data || result.data.thread_id !== state.currentThreadId || knownIndex === -1) {
+                return await this.fetchConversationHistory();
+            }
+            if (result.data.reset) { setHistoryPage(result.data); return result; }
+            state.currentHistory = [...state.temporaryHistory.slice(0, knownIndex + 1), ...(result.data.history || [])];
+            state.temporaryHistory = JSON.parse(JSON.stringify(state.currentHistory));
+            return result;
+        },
         async deleteFile(filename) {
             return await this._fetchAPI(`/api/files/${filename}`, { method: 'DELETE' });
         },
@@ -155,7 +218,7 @@ document.addEventListener('DOMContentLoaded', () => {
             return await this._fetchAPI('/api/threads/new', { method: 'POST' });
         },
         async activateThread(threadId) {
-            return await this._fetchAPI(`/api/threads/${threadId}/activate`, { method: 'POST' });
+            return await this._fetchAPI(`/api/threads/${threadId}/activate?limit=${HISTORY_PAGE_SIZE}`, { method: 'POST' });
         },
         async renameThread(threadId, newName) {
             return await this._fetchAPI(`/api/threads/${threadId}/rename`, {
@@ -166,12 +229,6 @@ document.addEventListener('DOMContentLoaded', () => {
         async deleteThread(threadId) {
             return await this._fetchAPI(`/api/threads/${threadId}/delete`, { method: 'DELETE' });
         },
-        async generateTitle(conversationData) {
-            return await this._fetchAPI('/api/generate-title', {
-                method: 'POST',
-                body: JSON.stringify(conversationData),
-            });
-        },
     };
     const ui = {
         displayModels(models) {
@@ -252,7 +309,41 @@ document.addEventListener('DOMContentLoaded', () => {
                 elements.threadsContainer.innerHTML = '<p class="no-threads-message">No threads yet</p>';
                 return;
             }
-            threads.sort((a, b) => new Date(b.updated_at) - new Date(a.updated_at));
+            this.appendThreads(threads, activeThreadId);
+        },
+        displaySearchResults(results) {
+            elements.searchResults.innerHTML = '';
+            if (!results || results.length === 0) {
+                elements.searchResults.innerHTML = '<p class="no-threads-message">No matches</p>';
+                return;
+            }
+            results.forEach(hit => {
+                const item = document.createElement('div');
+                item.className = 'search-result';
+                item.dataset.threadId = hit.thread_id;
+                const name = document.createElement('div');
+                name.className = 'thread-name';
+                name.textContent = hit.thread_name || 'Untitled Thread';
+                item.appendChild(name);
+                if (hit.position >= 0) {
+                    // The server escapes the snippet and marks the matched words
+                    const snippet = document.createElement('div');
+                    snippet.className = 'search-snippet';
+                    snippet.innerHTML = hit.snippet;
+                    item.appendChild(snippet);
+                } else {
+                    name.innerHTML = hit.snippet;
+                }
+                elements.searchResults.appendChild(item);
+            });
+        },
+        showSearchResults(visible) {
+            elements.searchResults.style.display = visible ? '' : 'none';
+            elements.threadsContainer.style.display = visible ? 'none' : '';
+        },
+        appendThreads(threads, activeThreadId) {
+            // Threads arrive most recently updated first, one page at a time
+            elements.threadsContainer.querySelector('.load-more-threads-btn')?.remove();
             threads.forEach(thread => {
                 const threadItem = document.createElement('div');
                 threadItem.className = 'thread-item';
@@ -278,10 +369,22 @@ document.addEventListener('DOMContentLoaded', () => {
                 threadItem.append(threadName, threadOptions);
                 elements.threadsContainer.appendChild(threadItem);
             });
+            if (state.threadsCursor) {
+                const loadMoreBtn = document.createElement('button');
+                loadMoreBtn.className = 'load-more-threads-btn';
+                loadMoreBtn.textContent = 'Show more threads';
+                elements.threadsContainer.appendChild(loadMoreBtn);
+            }
         },
         renderMessages(messagesToRender) {
             console.log(`Rendering ${messagesToRender.length} messages from temporary history.`);
             this.clearChatMessagesAndInserters();
+            if (state.historyOffset > 0) {
+                const loadEarlierBtn = document.createElement('button');
+                loadEarlierBtn.className = 'load-earlier-messages-btn';
+                loadEarlierBtn.textContent = `Load earlier messages (${state.historyOffset} more)`;
+                elements.chatMessages.prepend(loadEarlierBtn);
+            }
             if (!messagesToRender || messagesToRender.length === 0) {
                 this.addWelcomeMessage();
             } else {
@@ -310,7 +413,7 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         },
         clearChatMessagesAndInserters() {
-            const messagesToRemove = elements.chatMessages.querySelectorAll('.message-wrapper, .message-inserter:not(#top-message-inserter)');
+            const messagesToRemove = elements.chatMessages.querySelectorAll('.message-wrapper, .message-inserter:not(#top-message-inserter), .load-earlier-messages-btn');
             messagesToRemove.forEach(el => el.remove());
             const welcome = elements.chatMessages.querySelector('.welcome-message');
             if (welcome) welcome.remove();
@@ -523,6 +626,15 @@ document.addEventListener('DOMContentLoaded', () => {
         },
         showModal(modalElement) { modalElement.style.display = 'flex'; },
         hideModal(modalElement) { modalElement.style.display = 'none'; },
+        updateQueueStatus(indicator, position) {
+            let status = indicator.querySelector('.queue-status');
+            if (!status) {
+                status = document.createElement('span');
+                status.className = 'queue-status';
+                indicator.appendChild(status);
+            }
+            status.textContent = `Waiting for the model... position ${position} in queue`;
+        },
         createKittIndicator() {
             const existing = document.querySelector('.typing-indicator');
             if (existing) return existing;
@@ -694,14 +806,18 @@ document.addEventListener('DOMContentLoaded', () => {
         elements.messageInput.addEventListener('input', () => ui.adjustTextareaHeight(elements.messageInput));
         elements.uploadFilesBtn.addEventListener('click', () => elements.fileInput.click());
         elements.fileInput.addEventListener('change', handleFileInputChange);
+        elements.modelDropdown.addEventListener('change', () => { if (elements.modelDropdown.value) api.warmModel(elements.modelDropdown.value); });
         setupDragDropListeners();
         elements.clearConversationBtn.addEventListener('click', handleClearConversation);
         elements.newThreadBtn.addEventListener('click', handleNewThread);
         elements.threadsContainer.addEventListener('click', handleThreadContainerClick);
+        elements.threadSearchInput.addEventListener('input', handleThreadSearchInput);
+        elements.searchResults.addEventListener('click', handleSearchResultsClick);
         elements.settingsButton.addEventListener('click', handleSettingsButtonClick);
         elements.systemPromptInput.addEventListener('input', handleSystemPromptInput);
         elements.fileContextIntroInput.addEventListener('input', handleFileContextIntroInput);
         elements.appendFileContextSwitch.addEventListener('change', handleAppendContextSwitchChange);
+        elements.retrievalSwitch.addEventListener('change', handleRetrievalSwitchChange);
         if (elements.settingsModal) { 
             elements.settingsModal.addEventListener('click', handleModalBackgroundClick);
         } else {
@@ -793,8 +909,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!confirm(`Delete all messages in thread "${getCurrentThreadName()}" and reset title?`)) return;
         const result = await api.clearConversation();
         if (result.success) {
-            state.currentHistory = [];
-            state.temporaryHistory = [];
+            setHistoryPage({});
             ui.renderMessages(state.temporaryHistory);
             await api.fetchThreads();
             console.log('Conversation cleared and title reset.');
@@ -809,8 +924,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (result.success && result.data?.thread) {
             state.currentThreadId = result.data.thread.id;
             await api.fetchThreads();
-            state.currentHistory = [];
-            state.temporaryHistory = [];
+            setHistoryPage({});
             ui.renderMessages(state.temporaryHistory);
             ui.scrollToTop();
         } else {
@@ -818,6 +932,7 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     function handleThreadContainerClick(e) {
+        if (e.target.closest('.load-more-threads-btn')) { api.fetchMoreThreads(); return; }
         const threadItem = e.target.closest('.thread-item');
         if (!threadItem) return;
         const threadId = threadItem.dataset.threadId;
@@ -832,6 +947,27 @@ document.addEventListener('DOMContentLoaded', () => {
             handleActivateThread(threadId);
         }
     }
+    function handleThreadSearchInput() {
+        if (state.searchTimeout) clearTimeout(state.searchTimeout);
+        const query = elements.threadSearchInput.value.trim();
+        if (!query) { state.searchSeq++; ui.showSearchResults(false); return; }
+        state.searchTimeout = setTimeout(async () => {
+            const seq = ++state.searchSeq;
+            const result = await api.searchConversations(query);
+            if (seq !== state.searchSeq) return;  // a newer query was typed meanwhile
+            if (!result.success) console.error('Search failed:', result.error);
+            ui.displaySearchResults(result.success && result.data ? result.data.results : []);
+            ui.showSearchResults(true);
+        }, 200);
+    }
+    function handleSearchResultsClick(e) {
+        const item = e.target.closest('.search-result');
+        if (!item) return;
+        elements.threadSearchInput.value = '';
+        state.searchSeq++;
+        ui.showSearchResults(false);
+        handleActivateThread(item.dataset.threadId);
+    }
     async function handleActivateThread(threadId) {
         if (state.currentThreadId === threadId || state.isStreaming) return;
         if (hasUnsavedChanges() && !confirm("Discard unsaved changes and switch threads?")) return;
@@ -844,8 +980,7 @@ document.addEventListener('DOMContentLoaded', () => {
             document.querySelectorAll('.thread-item.active').forEach(el => el.classList.remove('active'));
             const newActiveItem = elements.threadsContainer.querySelector(`.thread-item[data-thread-id="${threadId}"]`);
             if (newActiveItem) newActiveItem.classList.add('active');
-            state.currentHistory = result.data.history || [];
-            state.temporaryHistory = JSON.parse(JSON.stringify(state.currentHistory));
+            setHistoryPage(result.data);
             ui.renderMessages(state.temporaryHistory);
             ui.scrollToTop();
         } else {
@@ -894,6 +1029,7 @@ document.addEventListener('DOMContentLoaded', () => {
         elements.systemPromptInput.value = state.systemPrompt;
         elements.fileContextIntroInput.value = state.fileContextIntro;
         elements.appendFileContextSwitch.checked = state.appendFileContext;
+        elements.retrievalSwitch.checked = state.useRetrieval ?? elements.retrievalSwitch.dataset.default === 'true';
         elements.saveStatusDiv.textContent = ''; 
         ui.showModal(elements.settingsModal);
     }
@@ -929,12 +1065,21 @@ document.addEventListener('DOMContentLoaded', () => {
         setTimeout(() => { elements.saveStatusDiv.textContent = ''; }, 2500);
         console.log(`Saved setting: appendFileContext = ${state.appendFileContext}`);
     }
+    function handleRetrievalSwitchChange() {
+        state.useRetrieval = elements.retrievalSwitch.checked;
+        localStorage.setItem('useRetrieval', JSON.stringify(state.useRetrieval));
+        elements.saveStatusDiv.textContent = 'Saved!';
+        elements.saveStatusDiv.style.color = 'var(--success-color)';
+        setTimeout(() => { elements.saveStatusDiv.textContent = ''; }, 2500);
+        console.log(`Saved setting: useRetrieval = ${state.useRetrieval}`);
+    }
     function handleModalBackgroundClick(event) {
         if (event.target === elements.settingsModal) ui.hideModal(elements.settingsModal);
         if (event.target === elements.renameThreadModal) ui.hideModal(elements.renameThreadModal);
     }
     function handleChatMessagesClick(e) {
         const target = e.target;
+        if (target.closest('.load-earlier-messages-btn')) { if (!state.isStreaming) api.fetchEarlierHistory(); return; }
         const messageWrapperElement = target.closest('.message-wrapper');
         const inserterElement = target.closest('.message-inserter');
         if (messageWrapperElement) {
@@ -1015,13 +1160,15 @@ async function handleResendMessageClick(messageIndex) {
             alert("Please select a model.");
             return;
         }
+        const incrementalOps = getIncrementalResendOps(messageIndex);
         const payload = {
             model: selectedModel,
-            messages: historyForResend, 
+            ...(incrementalOps || { messages: historyForResend, historyOffset: state.historyOffset }),
             references: filesForResend, 
             systemPrompt: state.systemPrompt,
             fileContextIntro: state.fileContextIntro,
             appendContext: state.appendFileContext,
+            ...(state.useRetrieval !== null && { retrieval: state.useRetrieval }),
         };
         await executeChatRequest(payload, true); 
     }
@@ -1033,6 +1180,7 @@ async function handleResendMessageClick(messageIndex) {
         if (!messageContent) { alert("Please enter a message."); return; }
         if (!selectedModel || selectedModel === "loading" || selectedModel === "") { alert("Please select a model."); return; }
         if (state.isStreaming) { console.warn("Already streaming."); return; }
+        const sendIncrementally = !hasUnsavedChanges();
         const newUserMessage = {
             role: 'user',
             content: userMessageContent,
@@ -1046,11 +1194,14 @@ async function handleResendMessageClick(messageIndex) {
         ui.scrollToBottom();
         const payload = {
             model: selectedModel,
-            messages: [...state.temporaryHistory], 
+            ...(sendIncrementally
+                ? { message: { content: userMessageContent, referencedFiles: filesForThisMessage } }
+                : { messages: [...state.temporaryHistory], historyOffset: state.historyOffset }),
             references: filesForThisMessage, 
             systemPrompt: state.systemPrompt,
             fileContextIntro: state.fileContextIntro,
             appendContext: state.appendFileContext,
+            ...(state.useRetrieval !== null && { retrieval: state.useRetrieval }),
         };
         await executeChatRequest(payload, false);
     }
@@ -1066,8 +1217,9 @@ async function handleResendMessageClick(messageIndex) {
         ui.scrollToBottom();
         state.abortController = new AbortController();
         let wasAborted = false;
+        const lastStoredMessage = [...state.temporaryHistory].reverse().find(msg => msg.id && !String(msg.id).startsWith('temp-'));
         try {
-            console.log(`Executing chat request. Resend: ${isResend}. History length: ${payload.messages.length}`);
+            console.log(`Executing chat request. Resend: ${isResend}. ${payload.messages ? `History length: ${payload.messages.length}` : 'Incremental'}`);
             console.log("Payload Settings:", { intro: payload.fileContextIntro, append: payload.appendContext }); 
             const response = await fetch('/api/chat', {
                 method: 'POST',
@@ -1083,11 +1235,11 @@ async function handleResendMessageClick(messageIndex) {
             }
             if (!response.body) throw new Error('Response body is null');
             await processChatStream(response.body, typingIndicator);
-            console.log("Stream finished successfully. Fetching definitive history.");
-            await api.fetchConversationHistory();
+            console.log("Stream finished successfully. Fetching new messages.");
+            await api.syncHistorySince(lastStoredMessage?.id);
             console.log("Re-rendering UI after history sync.");
             ui.renderMessages(state.temporaryHistory);
-            await generateThreadTitleIfNeeded();
+            pollThreadTitleIfNeeded();
         } catch (error) {
             console.error('Error during chat execution:', error);
             ui.hideTypingIndicator(typingIndicator);
@@ -1135,19 +1287,47 @@ async function handleResendMessageClick(messageIndex) {
         let serverResponseReceived = false;
         let tempBotMessage = null;
         let botMessageWrapperElement = null;
+        let pendingFrame = '';
+        let renderHandle = null;
+        // Markdown is re-rendered at most once per animation frame, however many events arrive in between
+        const renderBotMessage = () => {
+            renderHandle = null;
+            if (!tempBotMessage) return;
+            tempBotMessage.content = accumulatedContent;
+            tempBotMessage.thinking = hasThinking ? accumulatedThinking : null;
+            if (botMessageWrapperElement) {
+                ui.updateMessageElementDOM(botMessageWrapperElement, accumulatedContent, hasThinking ? accumulatedThinking : null);
+            } else {
+                console.warn("Bot message wrapper element not found for streaming update, re-rendering.");
+                ui.renderMessages(state.temporaryHistory);
+                botMessageWrapperElement = elements.chatMessages.querySelector(`.message-wrapper[data-message-index="${botMessageIndex}"]`);
+            }
+            ui.scrollToBottom();
+        };
+        const scheduleRender = () => {
+            if (renderHandle === null) renderHandle = requestAnimationFrame(renderBotMessage);
+        };
+        const flushRender = () => {
+            if (renderHandle !== null) { cancelAnimationFrame(renderHandle); renderBotMessage(); }
+        };
         try {
             while (true) {
                 const { done, value } = await reader.read();
                 if (done) {
                     break;
                 }
-                const chunk = decoder.decode(value, { stream: true });
-                const eventLines = chunk.split('\n\n');
-                for (const line of eventLines) {
+                // A frame can be split across reads; keep the unfinished tail for the next one
+                const frames = (pendingFrame + decoder.decode(value, { stream: true })).split('\n\n');
+                pendingFrame = frames.pop();
+                for (const line of frames) {
                     if (line.startsWith('data: ')) {
+                        let data;
+                        try { data = JSON.parse(line.substring(6)); } catch (e) { console.error('Error parsing SSE data:', e, "Raw Line:", line); continue; }
+                        if (data.error) throw new Error(data.error);
                         try {
-                            const data = JSON.parse(line.substring(6));
-                            if (data.content) {
+                            if (data.queue_position) ui.updateQueueStatus(typingIndicator, data.queue_position);
+                            if (data.context?.dropped_tokens) console.warn(`Context trimmed to fit the model: ${data.context.dropped_messages} older message(s) dropped, ${data.context.truncated_files.length} file(s) truncated (~${data.context.dropped_tokens} tokens).`);
+                            if (data.content || data.thinking) {
                                 if (!serverResponseReceived) {
                                      ui.hideTypingIndicator(typingIndicator);
                                      serverResponseReceived = true;
@@ -1157,24 +1337,20 @@ async function handleResendMessageClick(messageIndex) {
                                      ui.renderMessages(state.temporaryHistory);
                                      botMessageWrapperElement = elements.chatMessages.querySelector(`.message-wrapper[data-message-index="${botMessageIndex}"]`);
                                 }
-                                accumulatedContent += data.content;
-                                if (tempBotMessage) {
-                                    tempBotMessage.content = accumulatedContent;
-                                    tempBotMessage.thinking = hasThinking ? accumulatedThinking : null;
-                                }
-                                if (botMessageWrapperElement) {
-                                    ui.updateMessageElementDOM(botMessageWrapperElement, accumulatedContent, hasThinking ? accumulatedThinking : null);
-                                } else {
-                                    console.warn("Bot message wrapper element not found for streaming update, re-rendering.");
-                                    ui.renderMessages(state.temporaryHistory);
-                                    botMessageWrapperElement = elements.chatMessages.querySelector(`.message-wrapper[data-message-index="${botMessageIndex}"]`);
-                                }
-                                ui.scrollToBottom();
+                                if (data.thinking) { accumulatedThinking += data.thinking; hasThinking = true; }
+                                if (data.content) accumulatedContent += data.content;
+                                scheduleRender();
+                            }
+                            if (data.content_was_thinking && serverResponseReceived) {
+                                // The model's template opened <think> in the prompt: what looked like the reply was its thinking
+                                accumulatedThinking += accumulatedContent; accumulatedContent = ''; hasThinking = true;
+                                scheduleRender();
                             }
+                            if (data.stats) console.debug('Generation stats:', data.stats);
                             if (data.done) {
                                 return;
                             }
-                        } catch (e) { console.error('Error parsing SSE data:', e, "Raw Line:", line); }
+                        } catch (e) { console.error('Error handling SSE data:', e, "Raw Line:", line); }
                     }
                 }
             }
@@ -1182,6 +1358,7 @@ async function handleResendMessageClick(messageIndex) {
              console.error("Error reading from stream:", streamError);
             throw streamError;
         } finally {
+            flushRender();
             reader.releaseLock();
             console.log("Stream reader released.");
             ui.hideTypingIndicator(typingIndicator);
@@ -1195,14 +1372,17 @@ async function handleResendMessageClick(messageIndex) {
         let successCount = 0, errorCount = 0;
         const successfullyUploadedFilenames = []; 
         const uploadPromises = Array.from(files).map(file => {
-            const formData = new FormData(); formData.append('file', file);
-            return fetch('/api/upload', { method: 'POST', body: formData, credentials: 'include' })
+            // Send the file itself as the body so the server can stream it to disk
+            return fetch(`/api/upload?filename=${encodeURIComponent(file.name)}`, {
+                method: 'POST', body: file, credentials: 'include', headers: { 'Content-Type': 'application/octet-stream' }
+            })
                 .then(response => response.json())
                 .then(data => {
                     if (data.success) {
                         successCount++;
                         successfullyUploadedFilenames.push(data.filename); 
                     } else {
+                        console.error(`Upload failed for ${file.name}:`, data.error);
                         errorCount++;
                     }
                 })
@@ -1226,27 +1406,35 @@ async function handleResendMessageClick(messageIndex) {
             ui.updateSelectedFilesDisplay(); 
         }
     }
-    async function generateThreadTitleIfNeeded() {
-        const messagesForTitle = state.temporaryHistory;
+    async function pollThreadTitleIfNeeded() {
+        // The server queues title generation after the reply is saved; poll the thread list until the name changes.
+        const threadId = state.currentThreadId;
         const currentThreadName = getCurrentThreadName();
-        const shouldGenerate = messagesForTitle.length >= 2 && messagesForTitle.length <= 6 &&
-                               (!currentThreadName || currentThreadName.toLowerCase() === 'new thread');
-        if (!shouldGenerate) return;
-        const selectedModel = elements.modelDropdown.value;
-        if (!selectedModel || selectedModel === "loading" || selectedModel === "") return;
-        console.log(`Attempting title generation for thread ${state.currentThreadId}...`);
-        const conversation = {
-            messages: messagesForTitle.map(msg => ({ role: msg.role, content: msg.content })),
-            threadId: state.currentThreadId, model: selectedModel
-        };
-        const result = await api.generateTitle(conversation);
-        if (result.success && result.data?.title) {
-            console.log(`Generated title: "${result.data.title}". Renaming.`);
-            const renameResult = await api.renameThread(state.currentThreadId, result.data.title);
-            if (renameResult.success) await api.fetchThreads();
-            else console.error("Failed to rename thread with generated title:", renameResult.error);
-        } else if (!result.success) console.error('Error generating title:', result.error);
-        else console.log("Title generation returned no title.");
+        const shouldPoll = state.temporaryHistory.length >= 2 && state.temporaryHistory.length <= 6 &&
+                           (!currentThreadName || currentThreadName.toLowerCase() === 'new thread');
+        if (!shouldPoll) return;
+        for (let attempt = 0; attempt < 10; attempt++) {
+            await new Promise(resolve => setTimeout(resolve, 3000));
+            const result = await api.fetchThreads();
+            const thread = result.success ? (result.data?.threads || []).find(t => t.id === threadId) : null;
+            if (!thread || thread.name.toLowerCase() !== 'new thread') return;
+        }
+        console.log(`No generated title yet for thread ${threadId}, giving up polling.`);
+    }
+    function setHistoryPage(data) {
+        // `data` is a history response: the most recent messages of the thread, starting at position `offset`
+        state.currentHistory = data.history || [];
+        state.temporaryHistory = JSON.parse(JSON.stringify(state.currentHistory));
+        state.historyOffset = data.offset || 0;
+    }
+    function getIncrementalResendOps(messageIndex) {
+        const stored = state.currentHistory[messageIndex];
+        const local = state.temporaryHistory[messageIndex];
+        if (!stored || !local || stored.id !== local.id) return null;
+        const unchangedBefore = JSON.stringify(state.temporaryHistory.slice(0, messageIndex)) === JSON.stringify(state.currentHistory.slice(0, messageIndex));
+        if (!unchangedBefore) return null;
+        if (stored.content === local.content) return { truncateAfter: local.id };
+        return { edit: { id: local.id, content: local.content } };
     }
     function getCurrentThreadName() {
         const activeThreadElement = elements.threadsContainer.querySelector('.thread-item.active .thread-name');
@@ -0,0 +1,455 @@
+import os
+import re
+import html
+import json
+import socket
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from logs import get_logger
+log = get_logger('storage')
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS threads (
+    session_id TEXT NOT NULL, id TEXT NOT NULL, name TEXT NOT NULL,
+    created_at TEXT, updated_at TEXT,
+    PRIMARY KEY (session_id, id)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL, thread_id TEXT NOT NULL, position INTEGER NOT NULL,
+    id TEXT NOT NULL, data TEXT NOT NULL,
+    PRIMARY KEY (session_id, thread_id, position)
+);
+CREATE TABLE IF NOT EXISTS files (
+    session_id TEXT NOT NULL, name TEXT NOT NULL, sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL, uploaded_at TEXT,
+    PRIMARY KEY (session_id, name)
+);
+CREATE INDEX IF NOT EXISTS files_by_hash ON files (sha256);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL,
+    session_id TEXT, thread_id TEXT, kind TEXT NOT NULL
+);
+"""
+# Full-text search over message content and thread names. Each indexed text gets a row in search_docs (position -1
+# is the thread's name); its docid is the rowid in the FTS5 table, so a thread's entries are found without scanning it.
+# The FTS5 `session` column holds one token per session (see session_token) that every query must match, so only
+# the caller's own entries are ranked.
+SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_docs (
+    docid INTEGER PRIMARY KEY, session_id TEXT NOT NULL, thread_id TEXT NOT NULL, position INTEGER NOT NULL,
+    UNIQUE (session_id, thread_id, position)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(text, session, tokenize = 'unicode61 remove_diacritics 2');
+"""
+# Bumped when the index layout changes; build_search_index() then rebuilds it
+SEARCH_INDEX_VERSION = '2'
+# session_token() in SQL
+SESSION_TOKEN_SQL = "'s' || lower(hex({}))"
+NAME_POSITION = -1
+# Thread names count this many times as much as a message with the same score
+NAME_WEIGHT = 2.0
+SNIPPET_TOKENS = 16
+THREAD_FIELDS = ('id', 'name', 'created_at', 'updated_at')
+FILE_FIELDS = ('name', 'sha256', 'size', 'uploaded_at')
+# Uploads from before per-session files are listed for every session under this session id
+SHARED_SESSION = ''
+# Every write is also logged in `changes` so other processes sharing the database can refresh their caches
+CHANGE_LOG_SIZE = 10000
+def session_token(session_id):
+    # A single alphanumeric token for the session id, whatever characters it contains
+    return 's' + session_id.encode().hex()
+def search_query(session_id, text):
+    # An FTS5 query for the session's entries containing every word of `text`, the last one as a prefix
+    # (search-as-you-type); None if it has no words. Words are quoted, so FTS5 operators and punctuation typed by
+    # the user are matched literally.
+    words = re.findall(r'\w+', text)
+    if not words: return None
+    return f'session : "{session_token(session_id)}" AND text : (' + ' '.join(f'"{word}"' for word in words) + '*)'
+def highlight(snippet):
+    # Escapes a snippet for HTML and turns the \x02 ... \x03 match markers from snippet() into <mark> tags
+    return html.escape(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>')
+class ConversationStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.search_enabled = True
+        self._local = threading.local()
+    @staticmethod
+    def origin():
+        return f"{socket.gethostname()}:{os.getpid()}"
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection inherited across fork() (e.g. gunicorn --preload) must not be used by the child
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            if self.search_enabled:
+                try: conn.executescript(SEARCH_SCHEMA)
+                except sqlite3.OperationalError as e:
+                    # SQLite built without FTS5: everything but search still works
+                    log.warning(f"Full-text search disabled: {e}")
+                    self.search_enabled = False
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+    def _record(self, conn, session_id, thread_id, kind):
+        seq = conn.execute('INSERT INTO changes (origin, session_id, thread_id, kind) VALUES (?, ?, ?, ?)',
+                           (self.origin(), session_id, thread_id, kind)).lastrowid
+        if seq % 1000 == 0: conn.execute('DELETE FROM changes WHERE seq <= ?', (seq - CHANGE_LOG_SIZE,))
+    def latest_change(self):
+        return self._conn().execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+    def changes_since(self, seq):
+        # Returns ([(seq, origin, session_id, thread_id, kind)], complete); complete is False if the log was pruned past `seq`.
+        conn = self._conn()
+        rows = conn.execute('SELECT seq, origin, session_id, thread_id, kind FROM changes WHERE seq > ? ORDER BY seq', (seq,)).fetchall()
+        if rows and rows[0][0] != seq + 1:
+            oldest = conn.execute('SELECT MIN(seq) FROM changes').fetchone()[0]
+            return rows, oldest is None or oldest <= seq + 1
+        return rows, True
+    def load_thread(self, session_id, thread_id):
+        row = self._conn().execute('SELECT id, name, created_at, updated_at FROM threads WHERE session_id = ? AND id = ?',
+                                   (session_id, thread_id)).fetchone()
+        return dict(zip(THREAD_FIELDS, row)) if row else None
+    def load_threads(self):
+        result = {}
+        for row in self._conn().execute('SELECT session_id, id, name, created_at, updated_at FROM threads ORDER BY updated_at DESC, id DESC'):
+            result.setdefault(row[0], []).append(dict(zip(THREAD_FIELDS, row[1:])))
+        return result
+    def load_messages(self, session_id, thread_id):
+        rows = self._conn().execute('SELECT data FROM messages WHERE session_id = ? AND thread_id = ? ORDER BY position', (session_id, thread_id))
+        return [json.loads(data) for (data,) in rows]
+    def save_thread(self, session_id, thread):
+        with self._conn() as conn:
+            self._upsert_thread(conn, session_id, thread)
+            self._record(conn, session_id, thread['id'], 'thread')
+    def delete_thread(self, session_id, thread_id):
+        with self._conn() as conn:
+            self._unindex(conn, session_id, thread_id, NAME_POSITION)
+            conn.execute('DELETE FROM messages WHERE session_id = ? AND thread_id = ?', (session_id, thread_id))
+            conn.execute('DELETE FROM threads WHERE session_id = ? AND id = ?', (session_id, thread_id))
+            self._record(conn, session_id, thread_id, 'deleted')
+    def write_messages(self, session_id, thread_id, start, messages, thread=None):
+        # Replaces the thread's messages from position `start` onwards; everything before it is left untouched.
+        # Returns the number of bytes of message JSON written.
+        rows = [(session_id, thread_id, start + i, str(msg.get('id', '')), json.dumps(msg)) for i, msg in enumerate(messages)]
+        with self._conn() as conn:
+            self._unindex(conn, session_id, thread_id, start)
+            conn.execute('DELETE FROM messages WHERE session_id = ? AND thread_id = ? AND position >= ?', (session_id, thread_id, start))
+            conn.executemany('INSERT INTO messages (session_id, thread_id, position, id, data) VALUES (?, ?, ?, ?, ?)', rows)
+            self._index(conn, session_id, thread_id, start)
+            if thread is not None: self._upsert_thread(conn, session_id, thread)
+            self._record(conn, session_id, thread_id, 'messages')
+        return sum(len(row[4]) for row in rows)
+    def _upsert_thread(self, conn, session_id, thread):
+        self._index_name(conn, session_id, thread['id'], thread.get('name', ''))
+        conn.execute(
+            'INSERT INTO threads (session_id, id, name, created_at, updated_at) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (session_id, id) DO UPDATE SET name = excluded.name, created_at = excluded.created_at, updated_at = excluded.updated_at',
+            (session_id, thread['id'], thread.get('name', ''), thread.get('created_at'), thread.get('updated_at')))
+    def _index(self, conn, session_id=None, thread_id=None, start=0):
+        # Adds the thread's messages from `start` onwards to the search index (every thread's without ids)
+        if not self.search_enabled: return
+        scope, args = ('session_id = ? AND thread_id = ? AND ', (session_id, thread_id)) if session_id is not None else ('', ())
+        conn.execute(f"INSERT INTO search_docs (session_id, thread_id, position) SELECT session_id, thread_id, position FROM messages "
+                     f"WHERE {scope}position >= ? AND json_extract(data, '$.content') != ''", args + (start,))
+        conn.execute(f"INSERT INTO search_fts (rowid, text, session) SELECT docid, json_extract(data, '$.content'), {SESSION_TOKEN_SQL.format('session_id')} "
+                     f"FROM messages JOIN search_docs USING (session_id, thread_id, position) WHERE {scope}position >= ?", args + (start,))
+    def _unindex(self, conn, session_id, thread_id, start=0):
+        # Removes the thread's entries from position `start` onwards (NAME_POSITION includes its name)
+        if not self.search_enabled: return
+        args = (session_id, thread_id, start)
+        conn.execute('DELETE FROM search_fts WHERE rowid IN (SELECT docid FROM search_docs WHERE session_id = ? AND thread_id = ? AND position >= ?)', args)
+        conn.execute('DELETE FROM search_docs WHERE session_id = ? AND thread_id = ? AND position >= ?', args)
+    def _index_name(self, conn, session_id, thread_id, name):
+        if not self.search_enabled: return
+        row = conn.execute('SELECT d.docid, t.text FROM search_docs d JOIN search_fts t ON t.rowid = d.docid '
+                           'WHERE d.session_id = ? AND d.thread_id = ? AND d.position = ?', (session_id, thread_id, NAME_POSITION)).fetchone()
+        if row and row[1] == name: return  # most upserts only bump updated_at
+        if row: conn.execute('DELETE FROM search_fts WHERE rowid = ?', (row[0],))
+        else: row = (conn.execute('INSERT INTO search_docs (session_id, thread_id, position) VALUES (?, ?, ?)', (session_id, thread_id, NAME_POSITION)).lastrowid,)
+        conn.execute('INSERT INTO search_fts (rowid, text, session) VALUES (?, ?, ?)', (row[0], name, session_token(session_id)))
+    def build_search_index(self, force=False):
+        # Indexes everything stored before search existed, or before SEARCH_INDEX_VERSION; afterwards every write keeps the index current.
+        if not self.search_enabled: return 0
+        if not force and self.get_meta('search_index_version') == SEARCH_INDEX_VERSION: return 0
+        with self._conn() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if not force and conn.execute("SELECT value FROM meta WHERE key = 'search_index_version'").fetchone() == (SEARCH_INDEX_VERSION,): return 0
+            conn.execute('DROP TABLE IF EXISTS search_text')  # version 1, without the session column
+            conn.execute('DELETE FROM search_fts')
+            conn.execute('DELETE FROM search_docs')
+            conn.execute('INSERT INTO search_docs (session_id, thread_id, position) SELECT session_id, id, ? FROM threads', (NAME_POSITION,))
+            conn.execute(f"INSERT INTO search_fts (rowid, text, session) SELECT d.docid, t.name, {SESSION_TOKEN_SQL.format('t.session_id')} FROM search_docs d "
+                         "JOIN threads t ON t.session_id = d.session_id AND t.id = d.thread_id")
+            self._index(conn)
+            conn.execute("INSERT INTO search_fts (search_fts) VALUES ('optimize')")
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('search_index_version', SEARCH_INDEX_VERSION))
+            indexed = conn.execute('SELECT COUNT(*) FROM search_docs').fetchone()[0]
+        log.info(f"Built the search index: {indexed} entries")
+        return indexed
+    def search(self, session_id, text, limit=20, offset=0):
+        # Best matches first (BM25), as [{thread_id, position, message_id, role, snippet}]; position -1 is a thread name match.
+        query = search_query(session_id, text)
+        if query is None or not self.search_enabled: return []
+        rows = self._conn().execute(
+            "SELECT d.thread_id, d.position, m.id, json_extract(m.data, '$.role'), snippet(search_fts, 0, char(2), char(3), '…', ?) "
+            "FROM search_fts JOIN search_docs d ON d.docid = search_fts.rowid "
+            "LEFT JOIN messages m ON m.session_id = d.session_id AND m.thread_id = d.thread_id AND m.position = d.position "
+            "WHERE search_fts MATCH ? AND d.session_id = ? "
+            "ORDER BY bm25(search_fts, 1.0, 0.0) * (CASE WHEN d.position = ? THEN ? ELSE 1 END) LIMIT ? OFFSET ?",
+            (SNIPPET_TOKENS, query, session_id, NAME_POSITION, NAME_WEIGHT, limit, offset))
+        return [{'thread_id': thread_id, 'position': position, 'message_id': message_id, 'role': role, 'snippet': highlight(snippet)}
+                for thread_id, position, message_id, role, snippet in rows]
+    def load_files(self, session_id=None):
+        # {session_id: [file, ...]} for every session, or just the given session's list
+        if session_id is not None:
+            rows = self._conn().execute('SELECT name, sha256, size, uploaded_at FROM files WHERE session_id = ? ORDER BY name', (session_id,))
+            return [dict(zip(FILE_FIELDS, row)) for row in rows]
+        result = {}
+        for row in self._conn().execute('SELECT session_id, name, sha256, size, uploaded_at FROM files ORDER BY session_id, name'):
+            result.setdefault(row[0], []).append(dict(zip(FILE_FIELDS, row[1:])))
+        return result
+    def save_file(self, session_id, entry):
+        with self._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO files (session_id, name, sha256, size, uploaded_at) VALUES (?, ?, ?, ?, ?)',
+                         (session_id, entry['name'], entry['sha256'], entry['size'], entry.get('uploaded_at')))
+            self._record(conn, session_id, None, 'files')
+    def delete_file(self, session_id, name):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM files WHERE session_id = ? AND name = ?', (session_id, name))
+            self._record(conn, session_id, None, 'files')
+    def file_referenced(self, sha256):
+        return self._conn().execute('SELECT 1 FROM files WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone() is not None
+    def get_meta(self, key, default=None):
+        row = self._conn().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+    def set_meta(self, key, value):
+        with self._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+    def import_json(self, data_folder, force=False):
+        # One-time import of the legacy conversations.json / threads.json files, which are left in place.
+        if not force and self.get_meta('json_imported'): return 0
+        data_path = os.path.join(data_folder, 'conversations.json')
+        threads_path = os.path.join(data_folder, 'threads.json')
+        if not os.path.exists(data_path) and not os.path.exists(threads_path): return 0
+        try:
+            conversations, threads = {}, {}
+            if os.path.exists(data_path):
+                with open(data_path, 'r') as f: conversations = json.load(f)
+            if os.path.exists(threads_path):
+                with open(threads_path, 'r') as f: threads = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            log.error(f"Error reading legacy JSON data, not importing: {e}")
+            return 0
+        imported = 0
+        # Legacy threads may lack timestamps; NULLs would sort and page inconsistently
+        now = datetime.now().isoformat()
+        def stamped(thread):
+            created_at = thread.get('created_at') or thread.get('updated_at') or now
+            return {**thread, 'created_at': created_at, 'updated_at': thread.get('updated_at') or created_at}
+        with self._conn() as conn:
+            # Several workers may start at once: take the write lock before checking again, so only one imports
+            conn.execute('BEGIN IMMEDIATE')
+            if not force and conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone(): return 0
+            for session_id, session_threads in threads.items():
+                for thread in session_threads:
+                    if not isinstance(thread, dict) or 'id' not in thread: continue
+                    self._upsert_thread(conn, session_id, stamped(thread))
+            for session_id, session_conversations in conversations.items():
+                known = {t.get('id') for t in threads.get(session_id, []) if isinstance(t, dict)}
+                for thread_id, messages in session_conversations.items():
+                    if thread_id not in known:
+                        self._upsert_thread(conn, session_id, stamped({'id': thread_id, 'name': 'Imported Thread'}))
+                    self._unindex(conn, session_id, thread_id)
+                    conn.execute('DELETE FROM messages WHERE session_id = ? AND thread_id = ?', (session_id, thread_id))
+                    messages = [msg for msg in messages if isinstance(msg, dict)]
+                    conn.executemany(
+                        'INSERT INTO messages (session_id, thread_id, position, id, data) VALUES (?, ?, ?, ?, ?)',
+                        [(session_id, thread_id, i, str(msg.get('id', '')), json.dumps(msg)) for i, msg in enumerate(messages)])
+                    self._index(conn, session_id, thread_id)
+                    imported += 1
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('json_imported', '1'))
+            self._record(conn, None, None, 'all')
+        log.info(f"Imported {imported} threads from legacy JSON files in {data_folder}")
+        return imported
+class HistoryCache:
+    # Bounded LRU of thread histories; misses are faulted in from the store one thread at a time.
+    def __init__(self, store, max_threads=256):
+        self.store = store
+        self.max_threads = max(1, max_threads)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    def get(self, session_id, thread_id):
+        key = (session_id, thread_id)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        messages = self.store.load_messages(session_id, thread_id)
+        with self._lock:
+            messages = self._entries.setdefault(key, messages)
+            self._entries.move_to_end(key)
+            self._evict()
+        return messages
+    def put(self, session_id, thread_id, messages):
+        with self._lock:
+            self._entries[(session_id, thread_id)] = messages
+            self._entries.move_to_end((session_id, thread_id))
+            self._evict()
+    def discard(self, session_id, thread_id):
+        with self._lock:
+            self._entries.pop((session_id, thread_id), None)
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    def _evict(self):
+        while len(self._entries) > self.max_threads:
+            self._entries.popitem(last=False)
+    def __len__(self):
+        return len(self._entries)
+class ThreadIndex:
+    # Thread metadata per session: id -> thread dict, kept in most-recently-updated-first order as threads change.
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+    def load(self, sessions):
+        # `sessions` is {session_id: [thread, ...]} ordered most recent first, as returned by ConversationStore.load_threads()
+        with self._lock:
+            self._sessions = {sid: OrderedDict((t['id'], t) for t in session_threads) for sid, session_threads in sessions.items()}
+    def get(self, session_id, thread_id):
+        with self._lock:
+            return self._sessions.get(session_id, {}).get(thread_id)
+    def most_recent(self, session_id):
+        with self._lock:
+            return next(iter(self._sessions.get(session_id, {}).values()), None)
+    def add(self, session_id, thread):
+        with self._lock:
+            session_threads = self._sessions.setdefault(session_id, OrderedDict())
+            session_threads[thread['id']] = thread
+            session_threads.move_to_end(thread['id'], last=False)
+    def touch(self, session_id, thread_id, updated_at=None):
+        # Marks the thread as just updated and moves it to the front; returns it (None if unknown)
+        with self._lock:
+            session_threads = self._sessions.get(session_id, {})
+            thread = session_threads.get(thread_id)
+            if thread is None: return None
+            thread['updated_at'] = updated_at or datetime.now().isoformat()
+            session_threads.move_to_end(thread_id, last=False)
+            return thread
+    def upsert(self, session_id, thread):
+        # Applies a thread row written elsewhere, keeping the session in recency order
+        with self._lock:
+            session_threads = self._sessions.setdefault(session_id, OrderedDict())
+            current = session_threads.get(thread['id'])
+            if current is not None: current.update(thread); thread = current
+            else: session_threads[thread['id']] = thread
+            recency = lambda t: (t.get('updated_at') or '', t['id'])
+            first = next(iter(session_threads.values()))
+            if first is thread or recency(thread) >= recency(first): session_threads.move_to_end(thread['id'], last=False)
+            else: self._sessions[session_id] = OrderedDict(sorted(session_threads.items(), key=lambda item: recency(item[1]), reverse=True))
+    def remove(self, session_id, thread_id):
+        with self._lock:
+            return self._sessions.get(session_id, {}).pop(thread_id, None)
+    def count(self, session_id):
+        with self._lock:
+            return len(self._sessions.get(session_id, {}))
+    def page(self, session_id, limit=None, cursor=None):
+        # Returns (threads, next_cursor). The cursor is the (updated_at, id) of the last thread returned, so threads
+        # touched in between move to the front instead of shifting later pages.
+        after = tuple(cursor.split('|', 1)) if cursor else None
+        page = []
+        with self._lock:
+            for thread in self._sessions.get(session_id, {}).values():
+                if after and (thread.get('updated_at') or '', thread['id']) >= after: continue
+                if limit is not None and len(page) == limit:
+                    return page, f"{page[-1].get('updated_at') or ''}|{page[-1]['id']}"
+                page.append(thread)
+        return page, None
+class FileIndex:
+    # Uploaded file names per session: name -> {name, sha256, size, uploaded_at}, so listing and resolving
+    # references never touch the uploads directory. Files in SHARED_SESSION are visible to every session.
+    def __init__(self):
+        self._sessions = {}
+        self._names = {}
+        self._lock = threading.Lock()
+    def load(self, sessions):
+        # `sessions` is {session_id: [file, ...]}, as returned by ConversationStore.load_files()
+        with self._lock:
+            self._sessions = {sid: {f['name']: f for f in files} for sid, files in sessions.items()}
+            self._names = {}
+    def load_session(self, session_id, files):
+        with self._lock:
+            if files: self._sessions[session_id] = {f['name']: f for f in files}
+            else: self._sessions.pop(session_id, None)
+            self._invalidate(session_id)
+    def get(self, session_id, name, shared=True):
+        with self._lock:
+            entry = self._sessions.get(session_id, {}).get(name)
+            if entry is None and shared: entry = self._sessions.get(SHARED_SESSION, {}).get(name)
+            return entry
+    def owner(self, session_id, name):
+        # The session whose mapping `name` resolves to for this session, or None
+        with self._lock:
+            if name in self._sessions.get(session_id, {}): return session_id
+            return SHARED_SESSION if name in self._sessions.get(SHARED_SESSION, {}) else None
+    def names(self, session_id):
+        # Sorted file names visible to the session, rebuilt only after its files change
+        with self._lock:
+            names = self._names.get(session_id)
+            if names is None:
+                names = sorted(set(self._sessions.get(session_id, {})) | set(self._sessions.get(SHARED_SESSION, {})))
+                self._names[session_id] = names
+            return list(names)
+    def put(self, session_id, entry):
+        with self._lock:
+            self._sessions.setdefault(session_id, {})[entry['name']] = entry
+            self._invalidate(session_id)
+    def remove(self, session_id, name):
+        with self._lock:
+            entry = self._sessions.get(session_id, {}).pop(name, None)
+            self._invalidate(session_id)
+            return entry
+    def _invalidate(self, session_id):
+        if session_id == SHARED_SESSION: self._names.clear()
+        else: self._names.pop(session_id, None)
+class CacheSync:
+    # Keeps this process's ThreadIndex, HistoryCache and FileIndex in step with writes other processes make to the shared database.
+    def __init__(self, store, threads, history_cache, files=None):
+        self.store = store
+        self.threads = threads
+        self.history_cache = history_cache
+        self.files = files
+        self.last_seq = None
+        self._lock = threading.Lock()
+    def reset(self):
+        # Call right after loading the caches from the store
+        self.last_seq = self.store.latest_change()
+    def poll(self):
+        # Requests that arrive while another thread is polling wait for it: going ahead with stale caches could let
+        # prepare_chat compute its write offset from an outdated history and overwrite another worker's messages.
+        if self.last_seq is None: return 0
+        with self._lock:
+            rows, complete = self.store.changes_since(self.last_seq)
+            origin = self.store.origin()
+            if not complete or any(kind == 'all' and row_origin != origin for _, row_origin, _, _, kind in rows):
+                log.warning("Change log skipped ahead, reloading all threads from the store")
+                self.threads.load(self.store.load_threads()); self.history_cache.clear()
+                if self.files is not None: self.files.load(self.store.load_files())
+                self.last_seq = rows[-1][0] if rows else self.last_seq
+                return len(rows)
+            applied = 0
+            for seq, row_origin, session_id, thread_id, kind in rows:
+                self.last_seq = seq
+                if row_origin == origin: continue
+                if kind == 'files':
+                    if self.files is not None: self.files.load_session(session_id, self.store.load_files(session_id))
+                    applied += 1; continue
+                if kind != 'thread': self.history_cache.discard(session_id, thread_id)
+                thread = self.store.load_thread(session_id, thread_id)
+                if thread is None: self.threads.remove(session_id, thread_id)
+                else: self.threads.upsert(session_id, thread)
+                applied += 1
+            return applied
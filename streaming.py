@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import threading
+from logs import get_logger
+log = get_logger('streaming')
+# Consecutive reply fragments are merged into one SSE frame for up to this long (or this many characters); 0 sends every chunk.
+COALESCE_MS = float(os.environ.get('KITT_STREAM_COALESCE_MS', '40'))
+COALESCE_CHARS = int(os.environ.get('KITT_STREAM_COALESCE_CHARS', '2048'))
+THINK_OPEN, THINK_CLOSE = '<think>', '</think>'
+# Fragment/event sent when a reply without <think> reaches a </think>: what was streamed as content was thinking
+CONTENT_WAS_THINKING = 'content_was_thinking'
+def sse(event):
+    return f"data: {json.dumps(event)}\n\n"
+def _partial_tag(text, tag):
+    # Length of the longest suffix of `text` that could be the start of `tag`
+    for size in range(min(len(tag) - 1, len(text)), 0, -1):
+        if tag.startswith(text[-size:]): return size
+    return 0
+class ThinkingSplitter:
+    # Splits streamed reply text into ('thinking' | 'content', text) fragments as it arrives. A reply that opens
+    # with <think> is thinking up to </think>; tags split across chunks are held back until they can be told apart.
+    # Some chat templates put the opening <think> in the prompt, so the reply only has the closing tag: when the
+    # first </think> turns up in a reply that did not open with <think>, a (CONTENT_WAS_THINKING, None) fragment
+    # says the content sent so far was thinking, and the text up to the tag follows as thinking.
+    def __init__(self):
+        self.section = None  # None until the first non-blank text shows whether the reply opens with <think>
+        self._held = ''
+        self._leading = True  # drop whitespace at the start of each section
+        self._implicit = False  # in a reply without <think> that has not had a </think> yet
+    def feed(self, text):
+        text, self._held = self._held + text, ''
+        fragments = []
+        while text:
+            if self.section is None:
+                stripped = text.lstrip()
+                if stripped.startswith(THINK_OPEN): self.section, text = 'thinking', stripped[len(THINK_OPEN):]; continue
+                if not stripped or THINK_OPEN.startswith(stripped): self._held = text; break
+                self.section, self._implicit = 'content', True
+            if self.section == 'thinking':
+                end = text.find(THINK_CLOSE)
+                if end >= 0:
+                    self._emit(fragments, 'thinking', text[:end])
+                    self.section, self._leading, text = 'content', True, text[end + len(THINK_CLOSE):]
+                    continue
+                keep = _partial_tag(text, THINK_CLOSE)
+                self._emit(fragments, 'thinking', text[:len(text) - keep])
+                self._held = text[len(text) - keep:]
+                break
+            if self._implicit:
+                end = text.find(THINK_CLOSE)
+                if end >= 0:
+                    fragments.append((CONTENT_WAS_THINKING, None))
+                    self._leading = False
+                    self._emit(fragments, 'thinking', text[:end])
+                    self._implicit, self._leading, text = False, True, text[end + len(THINK_CLOSE):]
+                    continue
+                keep = _partial_tag(text, THINK_CLOSE)
+                self._emit(fragments, 'content', text[:len(text) - keep])
+                self._held = text[len(text) - keep:]
+                break
+            self._emit(fragments, 'content', text)
+            break
+        return fragments
+    def finish(self):
+        # Whatever was held back when the stream ends
+        text, self._held = self._held, ''
+        fragments = []
+        if text: self._emit(fragments, self.section or 'content', text)
+        return fragments
+    def _emit(self, fragments, section, text):
+        if self._leading: text = text.lstrip()
+        if not text: return
+        self._leading = False
+        fragments.append((section, text))
+class ChatStreamParser:
+    # Turns Ollama /api/chat NDJSON lines into {'thinking': ...} / {'content': ...} events and accumulates the reply.
+    def __init__(self):
+        self.error = None
+        self.finished = False
+        self.first_chunk_at = None
+        self.stats = {}
+        self.has_thinking = False
+        self._parts = {'thinking': [], 'content': []}
+        self._splitter = ThinkingSplitter()
+    @property
+    def content(self):
+        return ''.join(self._parts['content']).strip()
+    @property
+    def thinking(self):
+        # None when the reply had no thinking section
+        return ''.join(self._parts['thinking']).strip() if self.has_thinking else None
+    def feed(self, line):
+        try: chunk = json.loads(line)
+        except json.JSONDecodeError: log.warning("JSON decode failed: %s", line); return []
+        if chunk.get('error'):
+            log.error(f"Ollama error: {chunk['error']}")
+            self.error = chunk['error']; self.finished = True
+            return [{'error': chunk['error']}]
+        fragments = []
+        message = chunk.get('message') or {}
+        if message.get('thinking'):
+            # Ollama's own thinking field (models run with "think": true)
+            fragments.append(('thinking', message['thinking']))
+        if message.get('content'):
+            fragments.extend(self._splitter.feed(message['content']))
+        if chunk.get('done', False):
+            fragments.extend(self._splitter.finish())
+            if chunk.get('total_duration'):
+                # Ollama's timings for the whole request, in nanoseconds
+                self.stats = {k: chunk[k] for k in ('total_duration', 'load_duration', 'prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration') if k in chunk}
+                log.debug("Ollama stream finished."); self.finished = True
+        if (message.get('content') or message.get('thinking')) and self.first_chunk_at is None: self.first_chunk_at = time.monotonic()
+        events = []
+        for section, text in fragments:
+            if section == CONTENT_WAS_THINKING:
+                self._parts['thinking'].extend(self._parts['content']); self._parts['content'] = []
+                self.has_thinking = True
+                events.append({CONTENT_WAS_THINKING: True}); continue
+            if section == 'thinking': self.has_thinking = True
+            self._parts[section].append(text)
+            events.append({section: text})
+        return events
+class SSECoalescer:
+    # Buffers consecutive fragments of the same kind and renders them as one SSE frame once `window_ms` has passed
+    # since the last frame, or `max_chars` are waiting. The first fragment after a pause goes out at once, and
+    # other events flush what is buffered so the order is kept. Text is never held longer than the window: callers
+    # wait for upstream at most wait_time() seconds and then send due().
+    def __init__(self, window_ms=COALESCE_MS, max_chars=COALESCE_CHARS, clock=time.monotonic):
+        self.window = window_ms / 1000
+        self.max_chars = max_chars
+        self.clock = clock
+        self.frames = 0
+        self._kind = None
+        self._parts = []
+        self._size = 0
+        self._last_frame_at = None
+    def add(self, events):
+        # Returns the SSE text ready to send ('' while buffering)
+        out = []
+        for event in events:
+            kind = next(iter(event)) if len(event) == 1 else None
+            if kind not in ('thinking', 'content'):
+                out.append(self.flush()); out.append(sse(event)); self.frames += 1
+                continue
+            if self._parts and kind != self._kind: out.append(self.flush())
+            self._kind = kind; self._parts.append(event[kind]); self._size += len(event[kind])
+            now = self.clock()
+            if self.window <= 0 or self._size >= self.max_chars or self._last_frame_at is None or now - self._last_frame_at >= self.window:
+                out.append(self.flush())
+        return ''.join(out)
+    def wait_time(self):
+        # Seconds until the buffered text must be sent, or None when nothing is buffered
+        if not self._parts: return None
+        return max(0.0, self._last_frame_at + self.window - self.clock())
+    def due(self):
+        # The buffered text once its window has passed ('' before that)
+        wait = self.wait_time()
+        return self.flush() if wait is not None and wait <= 0 else ''
+    def flush(self):
+        if not self._parts: return ''
+        frame = sse({self._kind: ''.join(self._parts)})
+        self._parts, self._size, self._kind = [], 0, None
+        self._last_frame_at = self.clock(); self.frames += 1
+        return frame
+_END = object()
+def iter_with_timeouts(iterable, timeout):
+    # Yields the items of a blocking iterable, read on a background thread, and None whenever timeout() seconds
+    # pass without one (timeout() returning None waits for the next item). Errors from the iterable are re-raised.
+    items = queue.Queue()
+    def pump():
+        try:
+            for item in iterable: items.put(item)
+        except Exception as e: items.put(e)
+        finally: items.put(_END)
+    threading.Thread(target=pump, name='stream-reader', daemon=True).start()
+    while True:
+        try: item = items.get(timeout=timeout())
+        except queue.Empty: yield None; continue
+        if item is _END: return
+        if isinstance(item, Exception): raise item
+        yield item
+async def aiter_with_timeouts(aiterable, timeout):
+    # The asyncio version: the pending read is kept across timeouts rather than cancelled, so no data is lost.
+    iterator = aiterable.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None: pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=timeout())
+            if not done: yield None; continue
+            task, pending = pending, None
+            try: item = task.result()
+            except StopAsyncIteration: return
+            yield item
+    finally:
+        if pending is not None: pending.cancel()
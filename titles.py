@@ -0,0 +1,94 @@
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+import ollama_client
+from logs import get_logger
+log = get_logger('titles')
+TITLE_MODEL = os.environ.get('KITT_TITLE_MODEL', '')
+TITLE_BATCH_SIZE = int(os.environ.get('KITT_TITLE_BATCH_SIZE', '4'))
+TITLE_MAX_DELAY = float(os.environ.get('KITT_TITLE_MAX_DELAY', '120'))
+FALLBACK_TITLE = "Chat Summary"
+TITLE_SYSTEM_PROMPT = "Generate a concise, specific title (max 8 words) for the conversation snippet. Focus on the core topic. Avoid generic terms. Output ONLY the title."
+BATCH_SYSTEM_PROMPT = ("Generate a concise, specific title (max 8 words) for each numbered conversation snippet. Focus on the core topic. "
+                       "Avoid generic terms. Respond with JSON only: {\"titles\": [\"title for snippet 1\", \"title for snippet 2\", ...]}")
+def build_snippet(messages, max_snippet=6):
+    snippet_messages = messages[:max_snippet//2] + messages[-max_snippet//2:] if len(messages) > max_snippet else messages
+    snippet = "Snippet:\n"
+    for msg in snippet_messages:
+        role = "User" if msg.get("role") == "user" else "Assistant"
+        content = msg.get('content', '')[:150] + ('...' if len(msg.get('content', '')) > 150 else '')
+        snippet += f"{role}: {content}\n"
+    return snippet
+def clean_title(raw_title):
+    actual_title = (raw_title or '').strip()
+    if '</think>' in actual_title: actual_title = actual_title.split('</think>', 1)[1].strip()
+    title = re.sub(r'<.*?>', '', actual_title)
+    title = re.sub(r'^\W+|\W+$', '', title)
+    title = re.sub(r'\s+', ' ', title).strip()
+    return title[0].upper() + title[1:] if title else FALLBACK_TITLE
+def request_title(model, messages):
+    response = ollama_client.post('generate', json={"model": model, "system": TITLE_SYSTEM_PROMPT, "prompt": build_snippet(messages), "stream": False})
+    response.raise_for_status()
+    return clean_title(response.json().get("response", ""))
+def request_titles(model, conversations):
+    # One generation for several threads; falls back to one request per thread if the reply can't be parsed.
+    if len(conversations) == 1: return [request_title(model, conversations[0])]
+    prompt = "\n".join(f"{i}. {build_snippet(messages)}" for i, messages in enumerate(conversations, 1))
+    response = ollama_client.post('generate', json={"model": model, "system": BATCH_SYSTEM_PROMPT, "prompt": prompt, "stream": False, "format": "json"})
+    response.raise_for_status()
+    try:
+        titles = json.loads(response.json().get("response", ""))['titles']
+        if isinstance(titles, list) and len(titles) == len(conversations) and all(isinstance(t, str) for t in titles):
+            return [clean_title(t) for t in titles]
+    except (ValueError, KeyError, TypeError): pass
+    log.warning(f"Batched title reply from {model} was not usable, generating titles one by one")
+    return [request_title(model, messages) for messages in conversations]
+class TitleQueue:
+    # Background title generation: one pending job per thread (newer requests replace older ones), processed
+    # in batches per model, and held back while interactive chats are streaming.
+    def __init__(self, on_title, is_busy=lambda: False, needs_title=lambda session_id, thread_id: True):
+        self.on_title = on_title
+        self.is_busy = is_busy
+        self.needs_title = needs_title
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._worker = None
+    def submit(self, session_id, thread_id, messages, model):
+        model = TITLE_MODEL or model
+        if not model or not messages: return False
+        with self._cond:
+            self._pending[(session_id, thread_id)] = (model, [{'role': m.get('role'), 'content': m.get('content', '')} for m in messages])
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='title-queue', daemon=True)
+                self._worker.start()
+            self._cond.notify()
+        log.info(f"Queued title generation for thread {thread_id} ({model})")
+        return True
+    def pending(self):
+        with self._cond: return len(self._pending)
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending: self._cond.wait()
+            model = next(iter(self._pending.values()))[0]
+        # Lower priority than chat: wait until Ollama is idle (or we've waited long enough)
+        deadline = time.monotonic() + TITLE_MAX_DELAY
+        while self.is_busy() and time.monotonic() < deadline: time.sleep(0.5)
+        with self._cond:
+            keys = [key for key, job in self._pending.items() if job[0] == model][:max(1, TITLE_BATCH_SIZE)]
+            batch = [(key, self._pending.pop(key)[1]) for key in keys]
+        # Threads renamed (or titled by an earlier job) since they were queued don't need another generation
+        return model, [(key, messages) for key, messages in batch if self.needs_title(*key)]
+    def _run(self):
+        while True:
+            model, batch = self._next_batch()
+            if not batch: continue
+            try:
+                titles = request_titles(model, [messages for _, messages in batch])
+                for ((session_id, thread_id), _), title in zip(batch, titles):
+                    log.info(f"Generated title for thread {thread_id}: '{title}'")
+                    self.on_title(session_id, thread_id, title)
+            except Exception as e:
+                log.exception(f"Title generation failed for {len(batch)} thread(s) on {model}: {e}")
@@ -0,0 +1,5 @@
+# Production entry point for WSGI servers. Each worker process keeps its own caches in front of the shared
+# SQLite store in data/kitt.db and picks up the other workers' writes before every request. For example:
+#   gunicorn --worker-class gthread --workers 4 --threads 16 --bind 127.0.0.1:5000 wsgi:app
+from app import app, load_data
+load_data()